@@ -0,0 +1,330 @@
+"""igvm - Base Volumes
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+# Formatting a new volume and extracting the image into it takes minutes for
+# every VM.  Instead we keep a formatted volume with the extracted image on
+# every hypervisor, named after the SHA-256 digest of the image, and clone it
+# for the new VMs.  The fastest clone method of the storage is used:
+#
+#   zfs_clone       ZFS clone of the snapshot of the base volume
+#   thin_snapshot   LVM thin snapshot, when the volume group has a thin pool
+#   xfs_copy        copy of only the used blocks of the file system
+#
+# The base volumes are built under a temporary name and renamed at the end,
+# so concurrent builds of the same one don't see each other's half-built
+# volumes.  The one losing the race drops its own.  The image is streamed
+# into the base volume like into any other volume, it is not downloaded
+# separately for its digest.
+#
+# The base volume of the latest version of every image is recorded on the
+# hypervisor together with the checksum published for it on the image server
+# under bases/<image> of IMAGE_CACHE_PATH.  The record tells us whether we
+# have to build a new one without downloading the image, and which base
+# volumes are not the latest ones anymore to remove them.  The image cache
+# doesn't tell us that, because its images are evicted independently.
+
+from logging import getLogger
+from uuid import uuid4
+
+from igvm.exceptions import StorageError
+from igvm.imagecache import ImageCache
+from igvm.settings import BASE_VOLUME_SIZE_GIB, IMAGE_CACHE_PATH, VG_NAME
+
+log = getLogger(__name__)
+
+BASE_VOLUME_PREFIX = 'igvm-base_'
+BASE_SNAPSHOT = 'igvm'
+# Seconds to wait for the devices of the new volumes to appear
+DEVICE_TIMEOUT = 60
+
+
+class BaseVolume(object):
+    def __init__(self, hv, image):
+        self.hv = hv
+        self.image = image
+        self.storage_type = hv.get_storage_type()
+        self.name = None
+        if self.storage_type == 'zfs':
+            # The target of ZFS pools is /dev/zvol/<dataset>
+            self.dataset = hv.get_facts()['storage_pool_path'].split(
+                '/dev/zvol/', 1
+            )[-1]
+            self.thin_pool = None
+        elif self.storage_type == 'logical':
+            self.dataset = VG_NAME
+            self.thin_pool = self._get_thin_pool()
+        else:
+            raise StorageError(
+                'Base volumes are not supported on storage type {}'
+                .format(self.storage_type)
+            )
+
+    def get_clone_method(self):
+        if self.storage_type == 'zfs':
+            return 'zfs_clone'
+        if self.thin_pool:
+            return 'thin_snapshot'
+        return 'xfs_copy'
+
+    def path(self, name=None):
+        if self.storage_type == 'zfs':
+            return '/dev/zvol/{}/{}'.format(self.dataset, name or self.name)
+        return '/dev/{}/{}'.format(self.dataset, name or self.name)
+
+    def ensure(self):
+        """Make sure the base volume of the latest image exists"""
+        # This checks the image name for the records as well
+        md5 = ImageCache(self.hv).get_published_md5(self.image)
+        recorded_md5, recorded_name = self._get_record()
+        # Keep using the recorded one, if the image server is down
+        if recorded_name and md5 in (None, recorded_md5):
+            self.name = recorded_name
+            if self._exists():
+                log.info('Base volume {} of "{}" exists on "{}"'.format(
+                    self.name, self.image, self.hv
+                ))
+                return
+
+        log.info('Building base volume of "{}" on "{}"'.format(
+            self.image, self.hv
+        ))
+        # The temporary names have a dash after the prefix for prune()
+        tmp_name = '{}building-{}'.format(BASE_VOLUME_PREFIX, uuid4().hex[:8])
+        self._create(tmp_name)
+        try:
+            self.hv.format_storage(self.path(tmp_name))
+            mount_path = self.hv.mount_temp(self.path(tmp_name))
+            try:
+                digest = ImageCache(self.hv).extract(self.image, mount_path)
+            finally:
+                self.hv.umount_temp(mount_path)
+                self.hv.remove_temp(mount_path)
+
+            self.name = BASE_VOLUME_PREFIX + digest[:16]
+            renamed = self._rename(tmp_name)
+        except BaseException:
+            self._remove(tmp_name)
+            raise
+        if not renamed:
+            self._remove(tmp_name)
+            if not self._exists():
+                raise StorageError(
+                    'Failed to rename base volume {} to {} on "{}"'
+                    .format(tmp_name, self.name, self.hv)
+                )
+            log.info('Base volume {} was built concurrently'.format(self.name))
+        log.info('Built base volume {} of "{}" on "{}"'.format(
+            self.name, self.image, self.hv
+        ))
+        if md5:
+            self._set_record(md5)
+
+        self.prune()
+
+    def copy_to(self, device):
+        """Copy the used blocks of the base volume to the device"""
+        self.hv.run('xfs_copy {} {}'.format(self.path(), device), silent=True)
+
+    def clone(self, vol_name, size_gib):
+        """Create a volume as a snapshot or clone of the base volume
+
+        The clone is grown to the given size, if it is larger than the base
+        volume.
+        """
+        if size_gib < BASE_VOLUME_SIZE_GIB:
+            raise StorageError(
+                'Cannot clone base volume of {} GiB into a volume of {} GiB'
+                .format(BASE_VOLUME_SIZE_GIB, size_gib)
+            )
+
+        if self.get_clone_method() == 'zfs_clone':
+            create = 'zfs clone {0}/{1}@{2} {0}/{3}'.format(
+                self.dataset, self.name, BASE_SNAPSHOT, vol_name
+            )
+            commands = []
+            if size_gib > BASE_VOLUME_SIZE_GIB:
+                commands.append('zfs set volsize={}G {}/{}'.format(
+                    size_gib, self.dataset, vol_name
+                ))
+        else:
+            self._check_thin_pool_free(size_gib)
+            create = 'lvcreate -y -s -kn -n {} {}/{}'.format(
+                vol_name, self.dataset, self.name
+            )
+            commands = ['lvchange -ay {}/{}'.format(self.dataset, vol_name)]
+            # LVM fails to resize to the same size
+            if size_gib > BASE_VOLUME_SIZE_GIB:
+                commands.append('lvextend -L {}G {}/{}'.format(
+                    size_gib, self.dataset, vol_name
+                ))
+        # The clone is created on its own, so we know it is ours to remove,
+        # when anything after fails.
+        self.hv.run(create, silent=True)
+        try:
+            if commands:
+                self.hv.run_batch(commands)
+
+            # The clones have the same file system UUID as the base volume,
+            # which would prevent mounting them at the same time.
+            self._wait_for_device(vol_name)
+            self.hv.run(
+                'xfs_admin -U generate {}'.format(self.path(vol_name)),
+                silent=True,
+            )
+        except BaseException:
+            self._remove(vol_name, warn_only=True)
+            raise
+
+    def remove_clone(self, vol_name):
+        self._remove(vol_name)
+
+    def _check_thin_pool_free(self, size_gib):
+        """Check the thin pool has room for the whole clone
+
+        The thin snapshots don't take space from the volume group, so
+        the free space check of the hypervisor doesn't cover them.  We
+        count them with their whole size like any other volume, although
+        they share the blocks of the base volume until they are written.
+        The ZFS clones are covered, because they take their space from
+        the same pool.
+        """
+        pool_size, data_percent = self.hv.run(
+            'lvs --noheadings --units b --nosuffix -o lv_size,data_percent '
+            '{}/{}'.format(self.dataset, self.thin_pool),
+            silent=True,
+        ).split()
+        free_gib = (
+            int(pool_size) * (100 - float(data_percent)) / 100 / 1024 ** 3
+        )
+        if size_gib > free_gib:
+            raise StorageError(
+                'Not enough free space in thin pool {} for a volume of {} '
+                'GiB, {:.0f} GiB free'
+                .format(self.thin_pool, size_gib, free_gib)
+            )
+
+    def prune(self):
+        """Remove the base volumes which are not recorded as the latest
+
+        The ZFS ones stay as long as any clone of them exists.
+        """
+        latest = {name for md5, name in self._get_records()}
+        for name in self._list():
+            if name == self.name or name in latest:
+                continue
+            if '-' in name[len(BASE_VOLUME_PREFIX):]:
+                # Another one being built
+                continue
+            log.info('Removing base volume {} from "{}"'.format(
+                name, self.hv
+            ))
+            self._remove(name, warn_only=True)
+
+    def _get_record(self):
+        """Return the recorded checksum and base volume of the image"""
+        output = self.hv.run(
+            'cat {}/bases/{} 2>/dev/null || true'
+            .format(IMAGE_CACHE_PATH, self.image),
+            silent=True,
+        ).split()
+        if len(output) != 2:
+            return None, None
+        return output[0], output[1]
+
+    def _get_records(self):
+        """Return the recorded checksums and base volumes of all images"""
+        output = self.hv.run(
+            'cat {}/bases/* 2>/dev/null || true'.format(IMAGE_CACHE_PATH),
+            silent=True,
+        )
+        return [
+            tuple(line.split()) for line in output.splitlines()
+            if len(line.split()) == 2
+        ]
+
+    def _set_record(self, md5):
+        self.hv.run(
+            'mkdir -p {0}/bases && echo "{1} {2}" > {0}/bases/{3}.new && '
+            'mv {0}/bases/{3}.new {0}/bases/{3}'
+            .format(IMAGE_CACHE_PATH, md5, self.name, self.image),
+            silent=True,
+        )
+
+    def _wait_for_device(self, name):
+        self.hv.run(
+            "timeout {} sh -c 'while [ ! -e {} ]; do sleep 1; done'"
+            .format(DEVICE_TIMEOUT, self.path(name)),
+            silent=True,
+        )
+
+    def _get_thin_pool(self):
+        thin_pools = self.hv.run(
+            'lvs --noheadings -o lv_name -S segtype=thin-pool {}'
+            .format(VG_NAME),
+            silent=True,
+        ).split()
+        return thin_pools[0] if thin_pools else None
+
+    def _exists(self):
+        if self.storage_type == 'zfs':
+            command = 'zfs list -H -o name {}/{}@{}'.format(
+                self.dataset, self.name, BASE_SNAPSHOT
+            )
+        else:
+            command = 'lvs {}/{}'.format(self.dataset, self.name)
+        return self.hv.run(command, warn_only=True, silent=True).succeeded
+
+    def _list(self):
+        if self.storage_type == 'zfs':
+            output = self.hv.run(
+                'zfs list -H -o name -t volume -d 1 {}'.format(self.dataset),
+                silent=True,
+            )
+        else:
+            output = self.hv.run(
+                'lvs --noheadings -o lv_name {}'.format(self.dataset),
+                silent=True,
+            )
+        names = (
+            line.strip().rsplit('/', 1)[-1] for line in output.splitlines()
+        )
+        return [n for n in names if n.startswith(BASE_VOLUME_PREFIX)]
+
+    def _create(self, name):
+        if self.storage_type == 'zfs':
+            command = 'zfs create -V {}G {}/{}'.format(
+                BASE_VOLUME_SIZE_GIB, self.dataset, name
+            )
+        elif self.thin_pool:
+            command = 'lvcreate -y -n {} -V {}G -T {}/{}'.format(
+                name, BASE_VOLUME_SIZE_GIB, self.dataset, self.thin_pool
+            )
+        else:
+            command = 'lvcreate -y -n {} -L {}G {}'.format(
+                name, BASE_VOLUME_SIZE_GIB, self.dataset
+            )
+        self.hv.run(command, silent=True)
+        self._wait_for_device(name)
+
+    def _rename(self, tmp_name):
+        """Give the base volume its final name unless it exists already"""
+        if self.storage_type == 'zfs':
+            self.hv.run('zfs snapshot {}/{}@{}'.format(
+                self.dataset, tmp_name, BASE_SNAPSHOT
+            ))
+            command = 'zfs rename {0}/{1} {0}/{2}'
+        else:
+            command = 'lvrename {0} {1} {2}'
+        return self.hv.run(
+            command.format(self.dataset, tmp_name, self.name),
+            warn_only=True,
+            silent=True,
+        ).succeeded
+
+    def _remove(self, name, warn_only=False):
+        if self.storage_type == 'zfs':
+            command = 'zfs destroy -r {}/{}'.format(self.dataset, name)
+        else:
+            command = 'lvremove -fy {}/{}'.format(self.dataset, name)
+        self.hv.run(command, warn_only=warn_only, silent=warn_only)
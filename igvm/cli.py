@@ -6,6 +6,7 @@ Copyright (c) 2017 InnoGames GmbH
 from __future__ import print_function
 from argparse import ArgumentParser, _SubParsersAction
 from logging import StreamHandler, root as root_logger
+from os import getpid, path
 import time
 
 from fabric.network import disconnect_all
@@ -14,10 +15,13 @@ from igvm.commands import (
     change_address,
     disk_set,
     evacuate,
+    fleet_info,
     host_info,
+    image_prefetch,
     mem_set,
     vcpu_set,
     vm_build,
+    vm_build_many,
     vm_delete,
     vm_migrate,
     vm_rename,
@@ -25,8 +29,11 @@ from igvm.commands import (
     vm_start,
     vm_stop,
     vm_sync,
+    vm_sync_many,
 )
 from igvm.libvirt import close_virtconns
+from igvm.settings import TRACE_DIR, TRACE_FORMAT
+from igvm.tracing import export_trace, log_summary, span
 
 
 class ColorFormatters():
@@ -85,6 +92,18 @@ def parse_args():
     top_parser = IGVMArgumentParser('igvm')
     top_parser.add_argument('--silent', '-s', action='count', default=0)
     top_parser.add_argument('--verbose', '-v', action='count', default=0)
+    top_parser.add_argument(
+        '--trace',
+        dest='trace_file',
+        help='Write the trace of the command into this file',
+    )
+    top_parser.add_argument(
+        '--trace-format',
+        choices=['chrome', 'otlp'],
+        default=TRACE_FORMAT,
+        help='Format of the trace, Chrome trace JSON or OpenTelemetry '
+        'OTLP/JSON (default {})'.format(TRACE_FORMAT),
+    )
 
     subparsers = top_parser.add_subparsers(help='Actions')
 
@@ -126,6 +145,45 @@ def parse_args():
         help='Rebuild already defined VM or build it if not defined',
     )
 
+    subparser = subparsers.add_parser(
+        'build-many',
+        description=vm_build_many.__doc__,
+    )
+    subparser.set_defaults(func=vm_build_many)
+    subparser.add_argument(
+        'vm_hostnames',
+        nargs='+',
+        help='Hostnames of the guest systems',
+    )
+    subparser.add_argument(
+        '--postboot',
+        metavar='postboot_script',
+        help='Run postboot_script on the guests after first boot',
+    )
+    subparser.add_argument(
+        '--skip-puppet',
+        action='store_false',
+        dest='run_puppet',
+        help='Skip running puppet in chroot before powering up',
+    )
+    subparser.add_argument(
+        '--debug-puppet',
+        action='store_true',
+        help='Run puppet in debug mode',
+    )
+    subparser.add_argument(
+        '--ignore-reserved',
+        dest='allow_reserved_hv',
+        action='store_true',
+        help='Allow building on Hosts which have the state online_reserved',
+    )
+    subparser.add_argument(
+        '--max-builds',
+        type=int,
+        default=1,
+        help='Number of VMs to build at the same time (default 1)',
+    )
+
     subparser = subparsers.add_parser(
         'migrate',
         description=vm_migrate.__doc__,
@@ -166,7 +224,30 @@ def parse_args():
         '--offline-transport',
         default='drbd',
         help=(
-            'Specify drbd (default) or netcat transport to migrate disk image'
+            'Specify drbd (default), netcat, netcat_zstd, netcat_parallel or '
+            'netcat_diff transport to migrate disk image'
+        ),
+    )
+    subparser.add_argument(
+        '--keep-source-storage',
+        action='store_true',
+        help=(
+            'Keep the disk image on the source hypervisor for migrating back '
+            'with netcat_diff transport'
+        ),
+    )
+    subparser.add_argument(
+        '--drbd-rate',
+        help=(
+            'Resync rate of the drbd transport like 500M instead of the one '
+            'measured between the hypervisors'
+        ),
+    )
+    subparser.add_argument(
+        '--drbd-max-buffers',
+        help=(
+            'Max buffers of the drbd transport like 16k instead of the one '
+            'chosen for the measured throughput'
         ),
     )
     subparser.add_argument(
@@ -213,7 +294,8 @@ def parse_args():
         '--offline-transport',
         default='drbd',
         help=(
-            'Specify drbd (default) or netcat transport to migrate disk image'
+            'Specify drbd (default), netcat, netcat_zstd, netcat_parallel or '
+            'netcat_diff transport to migrate disk image'
         ),
     )
 
@@ -375,6 +457,76 @@ def parse_args():
         help='Shutdown VM, if running',
     )
 
+    subparser = subparsers.add_parser(
+        'sync-many',
+        description=vm_sync_many.__doc__,
+    )
+    subparser.set_defaults(func=vm_sync_many)
+    subparser.add_argument(
+        'hypervisor_hostnames',
+        nargs='*',
+        help='Hostnames of the hypervisors, all online ones by default',
+    )
+    subparser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Do not change Serveradmin but just print what would be changed',
+    )
+    subparser.add_argument(
+        '--max-workers',
+        type=int,
+        default=8,
+        help='Number of hypervisors to synchronize at the same time '
+        '(default 8)',
+    )
+
+    subparser = subparsers.add_parser(
+        'fleet-info',
+        description=fleet_info.__doc__,
+    )
+    subparser.set_defaults(func=fleet_info)
+    subparser.add_argument(
+        'hypervisor_hostnames',
+        nargs='*',
+        help='Hostnames of the hypervisors, all online ones by default',
+    )
+    subparser.add_argument(
+        '--format',
+        dest='output_format',
+        choices=['json', 'csv'],
+        default='json',
+        help='Output format (default json)',
+    )
+    subparser.add_argument(
+        '--max-workers',
+        type=int,
+        default=8,
+        help='Number of hypervisors to query at the same time (default 8)',
+    )
+
+    subparser = subparsers.add_parser(
+        'image-prefetch',
+        description=image_prefetch.__doc__,
+    )
+    subparser.set_defaults(func=image_prefetch)
+    subparser.add_argument(
+        'os_names',
+        nargs='+',
+        help='Operating systems of the images like the "os" attribute',
+    )
+    subparser.add_argument(
+        '--hypervisors',
+        nargs='+',
+        dest='hypervisor_hostnames',
+        help='Hostnames of the hypervisors, all online ones by default',
+    )
+    subparser.add_argument(
+        '--max-workers',
+        type=int,
+        default=8,
+        help='Number of hypervisors to prefetch at the same time (default 8)',
+    )
+
     subparser = subparsers.add_parser(
         'evacuate',
         description=evacuate.__doc__,
@@ -394,6 +546,12 @@ def parse_args():
         nargs='*',
         help='Migrate VMs matching the given serveradmin function offline',
     )
+    subparser.add_argument(
+        '--max-migrations',
+        type=int,
+        default=1,
+        help='Number of VMs to migrate at the same time (default 1)',
+    )
 
     return vars(top_parser.parse_args())
 
@@ -401,9 +559,15 @@ def parse_args():
 def main():
     args = parse_args()
     configure_root_logger(args.pop('silent'), args.pop('verbose'))
+    trace_file = args.pop('trace_file')
+    trace_format = args.pop('trace_format')
+    func = args.pop('func')
+    command = getattr(func, '__wrapped__', func).__name__
 
+    start = time.time()
     try:
-        args.pop('func')(**args)
+        with span('command', command):
+            func(**args)
     finally:
         # Fabric requires the disconnect function to be called after every
         # use.  We are also taking our chance to disconnect from
@@ -411,6 +575,14 @@ def main():
         disconnect_all()
         close_virtconns()
 
+        log_summary(time.time() - start)
+        if trace_file is None and TRACE_DIR:
+            trace_file = path.join(TRACE_DIR, 'igvm-{}-{}-{}.json'.format(
+                command, time.strftime('%Y%m%d%H%M%S'), getpid()
+            ))
+        if trace_file:
+            export_trace(trace_file, trace_format)
+
         # The underlying library of Fabric, Paramiko, raises an error, on
         # destruction right after the disconnect function is called.  We are
         # sleeping for a little while to avoid this.
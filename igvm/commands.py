@@ -3,17 +3,32 @@
 Copyright (c) 2018 InnoGames GmbH
 """
 
+import csv
+import json
 import logging
+import sys
+from datetime import datetime
 from os import environ
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager, ExitStack
+from itertools import islice
 
-from adminapi.dataset import Query
+from adminapi.dataset import DatasetError, Query
 from adminapi.filters import Any, StartsWith, Contains
 from fabric.colors import green, red, white, yellow
+from fabric.exceptions import NetworkError
 from fabric.network import disconnect_all
 from ipaddress import ip_address
 from jinja2 import Environment, PackageLoader
-from libvirt import libvirtError
+from libvirt import (
+    VIR_DOMAIN_BLOCKED,
+    VIR_DOMAIN_PAUSED,
+    VIR_DOMAIN_PMSUSPENDED,
+    VIR_DOMAIN_RUNNING,
+    VIR_DOMAIN_SHUTDOWN,
+    VIR_DOMAIN_SHUTOFF,
+    libvirtError,
+)
 
 from igvm.exceptions import (
     ConfigError,
@@ -25,13 +40,17 @@ from igvm.exceptions import (
 from igvm.host import with_fabric_settings
 from igvm.hypervisor import Hypervisor
 from igvm.hypervisor_preferences import sorted_hypervisors
+from igvm.querycache import query_cache
 from igvm.settings import (
     AWS_CONFIG,
     AWS_RETURN_CODES,
+    FLEET_INFO_COLUMNS,
     HYPERVISOR_ATTRIBUTES,
     HYPERVISOR_PREFERENCES,
+    HYPERVISOR_PREFETCH,
     VM_ATTRIBUTES,
 )
+from igvm.scheduler import Job, Scheduler
 from igvm.transaction import Transaction
 from igvm.utils import parse_size
 from igvm.vm import VM
@@ -57,7 +76,7 @@ def _check_defined(vm, fail_hard=True):
 
 
 @with_fabric_settings
-def evacuate(hv_hostname, offline=None, dry_run=False):
+def evacuate(hv_hostname, offline=None, dry_run=False, max_migrations=1):
     """Move all VMs out of a hypervisor
 
     Move all VMs out of a hypervisor and put it to state online reserved.
@@ -65,6 +84,13 @@ def evacuate(hv_hostname, offline=None, dry_run=False):
     Offline can be passed without arguments or with a list strings matching
     function attributes. If just passed all VMs will be migrated offline. If
     a list of strings is passed only those matching will be migrate offline.
+
+    Up to max_migrations VMs are migrated at the same time.  The
+    destinations are only chosen by the migrations themselves, so they
+    cannot be limited by the scheduler.  Every migration locks its VM and
+    its destination hypervisor on Serveradmin instead, so a destination
+    hypervisor never receives more than one VM at a time.  The hypervisors
+    already receiving a VM are skipped by the concurrent migrations.
     """
     with _get_hypervisor(hv_hostname, allow_reserved=True) as hv:
         if dry_run:
@@ -75,22 +101,70 @@ def evacuate(hv_hostname, offline=None, dry_run=False):
             hv.dataset_obj['state'] = 'online_reserved'
             hv.dataset_obj.commit()
 
+        jobs = []
         for vm in hv.dataset_obj['vms']:
             vm_function = vm['function']
-
-            if (
+            vm_offline = (
                 offline is not None and
                 (offline == [] or vm_function in offline)
-            ):
-                if dry_run:
-                    log.info('Would migrate {} offline'.format(vm['hostname']))
-                else:
-                    vm_migrate(vm['hostname'], offline=True)
-            else:
-                if dry_run:
-                    log.info('Would migrate {} online'.format(vm['hostname']))
-                else:
-                    vm_migrate(vm['hostname'])
+            )
+
+            if dry_run:
+                log.info('Would migrate {} {}'.format(
+                    vm['hostname'], 'offline' if vm_offline else 'online'
+                ))
+                continue
+
+            jobs.append(Job(
+                vm['hostname'],
+                _evacuate_vm,
+                (vm['hostname'], hv.fqdn, vm_offline),
+            ))
+
+        if not jobs:
+            return
+
+        results = Scheduler(max_migrations).run(jobs)
+
+    _log_job_results('Evacuation summary', results, lambda v: (
+        'migrated {} to {}'.format(
+            'offline' if v['offline'] else 'online', v['destination'],
+        )
+    ))
+
+    failed = [r for r in results if not r.succeeded]
+    if failed:
+        raise IGVMError(
+            'Failed to migrate {} of {} VMs: {}'.format(
+                len(failed), len(results),
+                ', '.join(r.job.name for r in failed),
+            )
+        )
+
+
+def _evacuate_vm(vm_hostname, source, offline):
+    """Migrate a single VM for evacuate() inside a scheduler worker"""
+    destination = vm_migrate(vm_hostname, offline=offline)
+
+    return {
+        'hostname': vm_hostname,
+        'source': source,
+        'destination': destination,
+        'offline': offline,
+    }
+
+
+def _log_job_results(title, results, describe):
+    log.info('{}:'.format(title))
+    for result in results:
+        if result.succeeded:
+            log.info('{}: {} in {:.0f}s'.format(
+                result.job.name, describe(result.value), result.duration,
+            ))
+        else:
+            log.error('{}: failed after {:.0f}s: {}'.format(
+                result.job.name, result.duration, result.error,
+            ))
 
 
 @with_fabric_settings
@@ -277,10 +351,12 @@ def change_address(
 
 @with_fabric_settings
 def vm_build(vm_hostname, run_puppet=True, debug_puppet=False, postboot=None,
-             allow_reserved_hv=False, rebuild=False):
+             allow_reserved_hv=False, rebuild=False, hypervisor_hostname=None):
     """Create a VM and start it
 
-    Puppet in run once to configure baseline networking.
+    Puppet in run once to configure baseline networking.  The hypervisor
+    is chosen automatically, unless the VM already has one, or one is
+    given.
     """
 
     with ExitStack() as es:
@@ -308,6 +384,12 @@ def vm_build(vm_hostname, run_puppet=True, debug_puppet=False, postboot=None,
         elif vm.dataset_obj['datacenter_type'] == 'kvm.dct':
             if vm.hypervisor:
                 es.enter_context(_lock_hv(vm.hypervisor))
+            elif hypervisor_hostname:
+                vm.hypervisor = es.enter_context(_get_hypervisor(
+                    hypervisor_hostname, allow_reserved=allow_reserved_hv
+                ))
+                vm.dataset_obj['hypervisor'] = \
+                    vm.hypervisor.dataset_obj['hostname']
             else:
                 vm.hypervisor = es.enter_context(_get_best_hypervisor(
                     vm,
@@ -339,13 +421,90 @@ def vm_build(vm_hostname, run_puppet=True, debug_puppet=False, postboot=None,
 
         vm.dataset_obj.commit()
 
+        if vm.hypervisor:
+            return vm.hypervisor.fqdn
+
+
+@with_fabric_settings
+def vm_build_many(vm_hostnames, run_puppet=True, debug_puppet=False,
+                  postboot=None, allow_reserved_hv=False, max_builds=1):
+    """Create many VMs and start them
+
+    The hypervisors of all VMs are chosen together before building any of
+    them, so the VMs placed earlier are accounted when placing the later
+    ones.  Up to max_builds VMs are built at the same time.  A hypervisor
+    is locked while a VM is being built on it, so it never builds more than
+    one VM at a time.
+    """
+    vms = [_query_vm(h) for h in vm_hostnames]
+    placements = _plan_placements(
+        [v for v in vms if v.dataset_obj['datacenter_type'] == 'kvm.dct'],
+        ['online', 'online_reserved'] if allow_reserved_hv else ['online'],
+    )
+
+    jobs = []
+    unplaced = []
+    for vm in vms:
+        hypervisor_hostname = placements.get(vm.fqdn)
+        if vm.dataset_obj['datacenter_type'] == 'kvm.dct' and not (
+            hypervisor_hostname
+        ):
+            unplaced.append(vm.fqdn)
+            continue
+
+        jobs.append(Job(
+            vm.fqdn,
+            _build_vm,
+            (vm.fqdn, hypervisor_hostname),
+            {
+                'run_puppet': run_puppet,
+                'debug_puppet': debug_puppet,
+                'postboot': postboot,
+                'allow_reserved_hv': allow_reserved_hv,
+            },
+            slots=[('hypervisor', hypervisor_hostname)],
+        ))
+
+    for vm_hostname in unplaced:
+        log.error('No hypervisor found for "{}"'.format(vm_hostname))
+
+    results = Scheduler(max_builds, {'hypervisor': 1}).run(jobs)
+    _log_job_results('Build summary', results, lambda v: (
+        'built on {}'.format(v) if v else 'built'
+    ))
+
+    failed = [r.job.name for r in results if not r.succeeded] + unplaced
+    if failed:
+        raise IGVMError(
+            'Failed to build {} of {} VMs: {}'.format(
+                len(failed), len(vms), ', '.join(failed),
+            )
+        )
+
+
+def _build_vm(vm_hostname, hypervisor_hostname, **kwargs):
+    """Build a single VM for vm_build_many() inside a scheduler worker"""
+    return vm_build(
+        vm_hostname, hypervisor_hostname=hypervisor_hostname, **kwargs
+    )
+
 
 @with_fabric_settings  # NOQA: C901
 def vm_migrate(vm_hostname=None, vm_object=None, hypervisor_hostname=None,
                run_puppet=False, debug_puppet=False,
                offline=False, offline_transport='drbd',
-               allow_reserved_hv=False, no_shutdown=False):
-    """Migrate a VM to a new hypervisor."""
+               allow_reserved_hv=False, no_shutdown=False,
+               keep_source_storage=False, drbd_rate=None,
+               drbd_max_buffers=None):
+    """Migrate a VM to a new hypervisor.
+
+    The storage volume can be kept on the source hypervisor to let
+    the netcat_diff offline transport send only the changed blocks when
+    the VM is migrated back.  The kept volume is removed, when the storage
+    of the VM is created on that hypervisor again for anything else.  The
+    resync rate and max-buffers of the drbd offline transport are measured
+    between the hypervisors unless given.
+    """
 
     if not (bool(vm_hostname) ^ bool(vm_object)):
         raise IGVMError(
@@ -404,7 +563,7 @@ def vm_migrate(vm_hostname=None, vm_object=None, hypervisor_hostname=None,
         with Transaction() as transaction:
             _vm.hypervisor.migrate_vm(
                 _vm, hypervisor, offline, offline_transport, transaction,
-                no_shutdown,
+                no_shutdown, drbd_rate, drbd_max_buffers,
             )
 
             previous_hypervisor = _vm.hypervisor
@@ -430,7 +589,11 @@ def vm_migrate(vm_hostname=None, vm_object=None, hypervisor_hostname=None,
 
         # If removing the existing VM fails we shouldn't risk undoing the newly
         # migrated one.
-        previous_hypervisor.undefine_vm(_vm)
+        previous_hypervisor.undefine_vm(
+            _vm, keep_storage=keep_source_storage
+        )
+
+        return hypervisor.fqdn
 
 
 @with_fabric_settings
@@ -608,13 +771,201 @@ def vm_sync(vm_hostname):
             )
 
 
+def vm_sync_many(hypervisor_hostnames=None, dry_run=False, max_workers=8):
+    """Synchronize resource attributes of all VMs on many hypervisors
+
+    Without hypervisor hostnames, the online hypervisors of the current
+    environment are used.  Up to max_workers hypervisors are handled at
+    the same time.  The actual values of all VMs of a hypervisor are
+    collected with a single libvirt call and a single volume listing.
+    Only the VMs with changes are locked to commit them, together per
+    hypervisor.  The VMs locked by other igvm commands are skipped.
+    """
+    scheduler = Scheduler(max_workers)
+    results = scheduler.run(
+        Job(h, _sync_hypervisor_vms, (h, dry_run))
+        for h in _query_hypervisor_hostnames(hypervisor_hostnames)
+    )
+
+    changes = []
+    failed_vms = []
+    for result in results:
+        if not result.succeeded:
+            log.error('{}: {}'.format(result.job.name, result.error))
+            continue
+        for hostname, attrib, current, value in result.value['changes']:
+            changes.append(hostname)
+            log.info('{}: {}: {} -> {}'.format(
+                hostname, attrib, current, value
+            ))
+        for hostname, error in result.value['failed']:
+            failed_vms.append(hostname)
+            log.error('{}: {}'.format(hostname, error))
+
+    log.info('{} {} attributes of {} VMs.'.format(
+        'Would synchronize' if dry_run else 'Synchronized',
+        len(changes),
+        len(set(changes)),
+    ))
+
+    failed = [r.job.name for r in results if not r.succeeded]
+    if failed or failed_vms:
+        raise IGVMError(
+            'Failed to synchronize the VMs of {}'.format(
+                ', '.join(failed + failed_vms)
+            )
+        )
+
+
+def _sync_hypervisor_vms(hv_hostname, dry_run):
+    """Synchronize the VMs of a hypervisor for vm_sync_many()
+
+    This runs inside a scheduler worker.  It returns the list of changes
+    as (hostname, attribute, current value, new value) tuples, and the list
+    of the failed VMs as (hostname, error) tuples.
+    """
+    hypervisor = Hypervisor(Query({
+        'hostname': hv_hostname,
+        'servertype': 'hypervisor',
+    }, HYPERVISOR_ATTRIBUTES).get())
+
+    changes = []
+    failed = []
+    changed_vms = []
+    for dataset_obj in Query({
+        'hypervisor': hv_hostname,
+        'servertype': 'vm',
+    }, VM_ATTRIBUTES):
+        vm = _sync_vm_from_dataset_obj(dataset_obj, hypervisor)
+        if dataset_obj['igvm_locked'] is not None:
+            log.warning('"{}" is locked, skipping.'.format(vm.fqdn))
+            continue
+        if not hypervisor.vm_defined(vm):
+            log.warning('"{}" is not defined on "{}", skipping.'.format(
+                vm.fqdn, hv_hostname
+            ))
+            continue
+
+        try:
+            vm_changes = _get_sync_changes(vm)
+        except (IGVMError, libvirtError) as error:
+            log.error('Failed to synchronize "{}": {}'.format(vm.fqdn, error))
+            failed.append((vm.fqdn, str(error)))
+            continue
+        if vm_changes:
+            changes.extend(vm_changes)
+            changed_vms.append(vm)
+
+    if changed_vms and not dry_run:
+        changes = [
+            c for c in changes
+            if c[0] not in {v.fqdn for v in changed_vms}
+        ]
+        try:
+            synced, sync_failed = _sync_vms(hypervisor, changed_vms)
+        except (IGVMError, DatasetError) as error:
+            log.error('Failed to synchronize the VMs of "{}": {}'.format(
+                hv_hostname, error
+            ))
+            synced = []
+            sync_failed = [(v.fqdn, str(error)) for v in changed_vms]
+        changes.extend(synced)
+        failed.extend(sync_failed)
+
+    return {'changes': changes, 'failed': failed}
+
+
+def _sync_vm_from_dataset_obj(dataset_obj, hypervisor):
+    # XXX: Ugly hack until adminapi supports modifying joined objects
+    dict.__setitem__(dataset_obj, 'hypervisor', hypervisor.fqdn)
+    return VM(dataset_obj, hypervisor)
+
+
+def _sync_vms(hypervisor, vms):
+    """Synchronize the changed VMs of a hypervisor for _sync_hypervisor_vms()
+
+    The VMs are locked together with a single commit, and compared again
+    with new snapshots of the hypervisor, so we don't race with the other
+    igvm commands changing them.  The changes are committed together with
+    unlocking.  It returns the changes and the failed VMs like
+    _sync_hypervisor_vms().
+    """
+    def vms_query():
+        return Query({
+            'object_id': Any(*(v.dataset_obj['object_id'] for v in vms)),
+        }, VM_ATTRIBUTES)
+
+    locked = []
+    query = vms_query()
+    for dataset_obj in query:
+        vm = _sync_vm_from_dataset_obj(dataset_obj, hypervisor)
+        if dataset_obj['igvm_locked'] is not None:
+            log.warning('"{}" got locked, skipping.'.format(vm.fqdn))
+            continue
+        dataset_obj['igvm_locked'] = datetime.utcnow()
+        locked.append(vm)
+    if not locked:
+        return [], []
+    try:
+        query.commit()
+    except DatasetError:
+        raise InvalidStateError(
+            'Some of the VMs are already being worked on by another igvm'
+        )
+
+    changes = []
+    failed = []
+    try:
+        hypervisor._invalidate_domain_stats()
+        hypervisor._invalidate_volume_index()
+        for vm in locked:
+            try:
+                vm_changes = _get_sync_changes(vm)
+            except (IGVMError, libvirtError) as error:
+                log.error('Failed to synchronize "{}": {}'.format(
+                    vm.fqdn, error
+                ))
+                failed.append((vm.fqdn, str(error)))
+                continue
+            for hostname, attrib, current, value in vm_changes:
+                vm.dataset_obj[attrib] = value
+            changes.extend(vm_changes)
+        # The failed VMs are unlocked without changing anything else.
+        for vm in locked:
+            vm.dataset_obj['igvm_locked'] = None
+        query.commit()
+    except (Exception, KeyboardInterrupt):
+        # Like _get_vm(), we re-fetch the VMs to commit nothing else than
+        # unlocking.
+        query = vms_query()
+        for dataset_obj in query:
+            if dataset_obj['object_id'] in {
+                v.dataset_obj['object_id'] for v in locked
+            }:
+                dataset_obj['igvm_locked'] = None
+        query.commit()
+        raise
+
+    return changes, failed
+
+
+def _get_sync_changes(vm):
+    attributes = vm.hypervisor.vm_sync_from_hypervisor(vm)
+    return [
+        (vm.fqdn, attrib, vm.dataset_obj[attrib], value)
+        for attrib, value in sorted(attributes.items())
+        if vm.dataset_obj[attrib] != value
+    ]
+
+
 @with_fabric_settings  # NOQA: C901
 def host_info(vm_hostname):
     """Extract runtime information about a VM
 
-    Library consumers should use VM.info() directly.
+    Library consumers should use VM.info() directly.  The VM is not locked,
+    and the Serveradmin queries are served from the cache.
     """
-    with _get_vm(vm_hostname) as vm:
+    with query_cache(), _get_vm(vm_hostname, lock=False) as vm:
 
         if vm.dataset_obj['datacenter_type'] != 'kvm.dct':
             raise NotImplementedError(
@@ -719,6 +1070,162 @@ def host_info(vm_hostname):
                 print('{} : {}'.format(k.ljust(max_key_len), value))
 
 
+def fleet_info(hypervisor_hostnames=None, output_format='json', max_workers=8):
+    """Extract runtime information about the VMs of many hypervisors
+
+    Without hypervisor hostnames, the online hypervisors of the current
+    environment are used.  Up to max_workers hypervisors are handled at
+    the same time.  The statistics of all domains of a hypervisor are
+    fetched with a single libvirt call.  The result is printed as JSON or
+    CSV.
+    """
+    if output_format not in ('json', 'csv'):
+        raise IGVMError('Unknown output format "{}"'.format(output_format))
+
+    scheduler = Scheduler(max_workers)
+    results = scheduler.run(
+        Job(h, _hypervisor_fleet_info, (h, ))
+        for h in _query_hypervisor_hostnames(hypervisor_hostnames)
+    )
+
+    rows = []
+    for result in results:
+        if result.succeeded:
+            rows.extend(result.value)
+        else:
+            log.error('{}: {}'.format(result.job.name, result.error))
+
+    if output_format == 'json':
+        print(json.dumps(rows, indent=4, sort_keys=True))
+    else:
+        writer = csv.DictWriter(sys.stdout, FLEET_INFO_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _query_hypervisor_hostnames(hypervisor_hostnames=None):
+    """Return the given hypervisors or the online ones of the environment"""
+    if hypervisor_hostnames:
+        filters = {'hostname': Any(*hypervisor_hostnames)}
+    else:
+        filters = {
+            'environment': environ.get('IGVM_MODE', 'production'),
+            'state': Any('online', 'online_reserved'),
+        }
+    filters['servertype'] = 'hypervisor'
+    with query_cache():
+        return [o['hostname'] for o in Query(filters, ['hostname'])]
+
+
+def _hypervisor_fleet_info(hv_hostname):
+    """Collect information about the VMs of a hypervisor for fleet_info()
+
+    This runs inside a scheduler worker.
+    """
+    with query_cache():
+        hypervisor = Hypervisor(Query({
+            'hostname': hv_hostname,
+            'servertype': 'hypervisor',
+        }, HYPERVISOR_ATTRIBUTES).get())
+        dataset_objs = list(Query({
+            'hypervisor': hv_hostname,
+            'servertype': 'vm',
+        }, VM_ATTRIBUTES))
+
+    domain_stats = hypervisor.get_domain_stats()
+    rows = []
+    for dataset_obj in dataset_objs:
+        # XXX: Ugly hack until adminapi supports modifying joined objects
+        dict.__setitem__(dataset_obj, 'hypervisor', hv_hostname)
+        rows.append(_vm_fleet_info(VM(dataset_obj, hypervisor), domain_stats))
+    return rows
+
+
+def _vm_fleet_info(vm, domain_stats):
+    row = {
+        'hostname': vm.fqdn,
+        'hypervisor': vm.hypervisor.fqdn,
+        'state': vm.dataset_obj['state'],
+        'num_cpu': vm.dataset_obj['num_cpu'],
+        'memory': vm.dataset_obj['memory'],
+        'disk_size_gib': vm.dataset_obj['disk_size_gib'],
+    }
+
+    domain = vm.hypervisor._find_domain(vm)
+    if domain is None:
+        row['status'] = 'new'
+        return row
+    stats = domain_stats.get(domain.name(), {})
+    state = stats.get('state.state', VIR_DOMAIN_SHUTOFF)
+    if state not in (VIR_DOMAIN_RUNNING, VIR_DOMAIN_BLOCKED):
+        # We must not try to log into the paused domains or the ones being
+        # shut down, they wouldn't answer.
+        row['status'] = {
+            VIR_DOMAIN_PAUSED: 'paused',
+            VIR_DOMAIN_SHUTDOWN: 'shutting down',
+            VIR_DOMAIN_PMSUSPENDED: 'suspended',
+        }.get(state, 'stopped')
+        return row
+
+    row.update({
+        'status': 'running',
+        'vcpus': stats.get('vcpu.current'),
+        'memory_actual': stats.get('balloon.current', 0) // 1024,
+        'disk_capacity_gib': round(
+            stats.get('block.0.capacity', 0) / 1024 ** 3, 2
+        ),
+    })
+    try:
+        guest_stats = vm.guest_stats()
+    except (IGVMError, NetworkError) as error:
+        row['error'] = str(error)
+    else:
+        guest_stats['load'] = ' '.join(guest_stats['load'])
+        row.update(guest_stats)
+    return row
+
+
+def image_prefetch(os_names, hypervisor_hostnames=None, max_workers=8):
+    """Download the images into the image cache of many hypervisors
+
+    This warms up the hypervisors before large rollouts.  Without
+    hypervisor hostnames, the online hypervisors of the current environment
+    are used.  Up to max_workers hypervisors are handled at the same time.
+    """
+    images = [o + '-base.tar.gz' for o in os_names]
+    scheduler = Scheduler(max_workers)
+    results = scheduler.run(
+        Job(h, _prefetch_hypervisor_images, (h, images))
+        for h in _query_hypervisor_hostnames(hypervisor_hostnames)
+    )
+
+    failed = [r.job.name for r in results if not r.succeeded]
+    for result in results:
+        if not result.succeeded:
+            log.error('{}: {}'.format(result.job.name, result.error))
+    log.info('Prefetched {} images on {} hypervisors.'.format(
+        len(images), len(results) - len(failed)
+    ))
+    if failed:
+        raise IGVMError(
+            'Failed to prefetch the images on {}'.format(', '.join(failed))
+        )
+
+
+def _prefetch_hypervisor_images(hv_hostname, images):
+    """Prefetch the images on a hypervisor for image_prefetch()
+
+    This runs inside a scheduler worker.
+    """
+    with query_cache():
+        hypervisor = Hypervisor(Query({
+            'hostname': hv_hostname,
+            'servertype': 'hypervisor',
+        }, HYPERVISOR_ATTRIBUTES).get())
+    for image in images:
+        hypervisor.prefetch_image(image)
+
+
 @with_fabric_settings
 def vm_rename(vm_hostname, new_hostname, offline=False):
     """Redefine the VM on the same hypervisor with a different name
@@ -749,11 +1256,12 @@ def vm_rename(vm_hostname, new_hostname, offline=False):
 
 
 @contextmanager
-def _get_vm(hostname, unlock=True, allow_retired=False):
+def _get_vm(hostname, unlock=True, allow_retired=False, lock=True):
     """Get a server from Serveradmin by hostname to return VM object
 
     The function is accepting hostnames in any length as long as it resolves
-    to a single server on Serveradmin.
+    to a single server on Serveradmin.  Read-only commands can skip locking
+    the VM.
     """
 
     object_id = Query({
@@ -767,18 +1275,12 @@ def _get_vm(hostname, unlock=True, allow_retired=False):
         }, VM_ATTRIBUTES).get()
 
     dataset_obj = vm_query()
-
-    hypervisor = None
-    if dataset_obj['hypervisor']:
-        hypervisor = Hypervisor(dataset_obj['hypervisor'])
-
-        # XXX: Ugly hack until adminapi supports modifying joined objects
-        dict.__setitem__(
-            dataset_obj, 'hypervisor', dataset_obj['hypervisor']['hostname']
-        )
-
-    vm = VM(dataset_obj, hypervisor)
-    vm.acquire_lock()
+    vm = _vm_from_dataset_obj(dataset_obj)
+    hypervisor = vm.hypervisor
+    if lock:
+        vm.acquire_lock()
+    else:
+        unlock = False
 
     try:
         if not allow_retired and dataset_obj['state'] == 'retired':
@@ -789,7 +1291,8 @@ def _get_vm(hostname, unlock=True, allow_retired=False):
             )
         yield vm
     except (Exception, KeyboardInterrupt):
-        VM(vm_query(), hypervisor).release_lock()
+        if lock:
+            VM(vm_query(), hypervisor).release_lock()
         raise
     else:
         # We re-fetch the VM because we can't risk commiting any other changes
@@ -801,6 +1304,30 @@ def _get_vm(hostname, unlock=True, allow_retired=False):
             VM(vm_query(), hypervisor).release_lock()
 
 
+def _query_vm(hostname):
+    """Get a server from Serveradmin by hostname to return VM object
+
+    Unlike _get_vm(), the VM is not locked.
+    """
+    return _vm_from_dataset_obj(Query({
+        'hostname': Any(hostname, StartsWith(hostname + '.')),
+        'servertype': 'vm',
+    }, VM_ATTRIBUTES).get())
+
+
+def _vm_from_dataset_obj(dataset_obj):
+    hypervisor = None
+    if dataset_obj['hypervisor']:
+        hypervisor = Hypervisor(dataset_obj['hypervisor'])
+
+        # XXX: Ugly hack until adminapi supports modifying joined objects
+        dict.__setitem__(
+            dataset_obj, 'hypervisor', dataset_obj['hypervisor']['hostname']
+        )
+
+    return VM(dataset_obj, hypervisor)
+
+
 @contextmanager
 def _get_hypervisor(hostname, allow_reserved=False):
     """Get a server from Serveradmin by hostname to return Hypervisor object"""
@@ -834,9 +1361,17 @@ def _get_best_hypervisor(vm, hypervisor_states, offline=False):
         'state': Any(*hypervisor_states),
     }, HYPERVISOR_ATTRIBUTES))
 
-    for hypervisor in sorted_hypervisors(
-        HYPERVISOR_PREFERENCES, vm, hypervisors
+    for hypervisor, error in _prefetch_check_vm(
+        sorted_hypervisors(HYPERVISOR_PREFERENCES, vm, hypervisors),
+        vm, offline, HYPERVISOR_PREFETCH,
     ):
+        if error is not None:
+            log.warning(
+                'Preferred hypervisor "{}" is skipped: {}'.format(
+                    hypervisor, error)
+            )
+            continue
+
         # The actual resources are not checked during sorting for performance.
         # We need to validate the hypervisor using the actual values before
         # the final decision.
@@ -880,6 +1415,105 @@ def _get_best_hypervisor(vm, hypervisor_states, offline=False):
         )
 
 
+def _plan_placements(vms, hypervisor_states):
+    """Choose hypervisors for the VMs to be built together
+
+    The hypervisors are queried only once.  Every VM placed is accounted on
+    its hypervisor before placing the next one, so the hypervisor
+    preferences and the resource checks see the VMs placed earlier.
+    Nothing is locked in here, the hypervisors are locked and validated
+    again when the VMs are built.  All VMs are checked against the same
+    snapshots of the domains and the volumes of the hypervisors taken by
+    the first check.  Returns a dict of VM hostname to hypervisor hostname.
+    The VMs no hypervisor is found for are missing.
+    """
+    placements = {}
+    new_vms = []
+    for vm in vms:
+        if vm.hypervisor:
+            placements[vm.fqdn] = vm.hypervisor.fqdn
+        else:
+            new_vms.append(vm)
+
+    if not new_vms:
+        return placements
+
+    hv_env = environ.get('IGVM_MODE', 'production')
+    hypervisors = [Hypervisor(o) for o in Query({
+        'servertype': 'hypervisor',
+        'environment': hv_env,
+        'vlan_networks': Any(*set(v.route_network for v in new_vms)),
+        'state': Any(*hypervisor_states),
+    }, HYPERVISOR_ATTRIBUTES)]
+
+    for vm in new_vms:
+        candidates = [
+            h for h in hypervisors
+            if h.get_vlan_network(vm.dataset_obj['intern_ip'])
+        ]
+        for hypervisor, error in _prefetch_check_vm(
+            sorted_hypervisors(HYPERVISOR_PREFERENCES, vm, candidates),
+            vm, True, max(HYPERVISOR_PREFETCH, 1), use_copies=False,
+        ):
+            if error is not None:
+                log.warning(
+                    'Preferred hypervisor "{}" is skipped for "{}": {}'
+                    .format(hypervisor, vm, error)
+                )
+                continue
+
+            hypervisor.plan_vm(vm)
+            placements[vm.fqdn] = hypervisor.fqdn
+            log.info('"{}" is planned to be built on "{}"'.format(
+                vm, hypervisor
+            ))
+            break
+
+    return placements
+
+
+def _prefetch_check_vm(hypervisors, vm, offline, count, use_copies=True):
+    """Validate the hypervisors concurrently in batches without locking
+
+    Yields the hypervisors in the given order together with the error
+    found by check_vm(), or None if the hypervisor is usable.  We are only
+    looking for the errors the callers would skip the hypervisor for.
+    The rest is left for the validation after the hypervisor is locked.
+    The checks are done on copies of the hypervisors, so that the validation
+    after locking doesn't reuse anything seen without the lock.  The callers
+    never locking the hypervisors can disable this to let the checks share
+    the snapshots of the hypervisors.  Zero count disables the prefetching.
+    """
+    if count < 1:
+        for hypervisor in hypervisors:
+            yield hypervisor, None
+        return
+
+    def check(hypervisor):
+        try:
+            if use_copies:
+                hypervisor = hypervisor.copy()
+            hypervisor.check_vm(vm, offline)
+        except (libvirtError, HypervisorError) as error:
+            return error
+        except Exception:
+            # Let the validation with the lock fail properly
+            pass
+        return None
+
+    hypervisors = iter(hypervisors)
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        while True:
+            batch = list(islice(hypervisors, count))
+            if not batch:
+                break
+            log.debug('Validating {} hypervisors concurrently'.format(
+                len(batch)
+            ))
+            for hypervisor, error in zip(batch, executor.map(check, batch)):
+                yield hypervisor, error
+
+
 @contextmanager
 def _lock_hv(hv):
     hv.acquire_lock()
@@ -6,7 +6,16 @@ Copyright (c) 2018 InnoGames GmbH
 from contextlib import contextmanager
 from io import BytesIO
 from logging import getLogger
-from time import sleep
+import re
+from time import time
+
+from igvm.settings import (
+    DRBD_MAX_BUFFERS,
+    DRBD_PROBE_SIZE_MIB,
+    DRBD_PROGRESS_INTERVAL,
+    DRBD_RESYNC_SHARE,
+)
+from igvm.tracing import span, traced
 
 log = getLogger(__name__)
 
@@ -50,8 +59,83 @@ class DRBD(object):
             .format(self.vg_name, self.lv_name)
         ).strip())
 
+    def get_tuning(self, peer, rate=None, max_buffers=None):
+        """Choose the resync rate and max-buffers for the replication
+
+        The values are derived from the measured throughput between the
+        hypervisors, unless both of them are given.  The given ones always
+        override the measured ones.
+        """
+        if rate is None or max_buffers is None:
+            throughput = self.measure_throughput(peer)
+            usable = min(throughput.values()) * DRBD_RESYNC_SHARE
+            if rate is None:
+                rate = '{}M'.format(max(int(usable), 1))
+            if max_buffers is None:
+                for limit, max_buffers in DRBD_MAX_BUFFERS:
+                    if usable <= limit:
+                        break
+            log.info(
+                'Measured throughput for {}: link {:.0f} MiB/s, '
+                'source disk read {:.0f} MiB/s, '
+                'destination disk write {:.0f} MiB/s'
+                .format(
+                    self.vm_name,
+                    throughput['link'],
+                    throughput['read'],
+                    throughput['write'],
+                )
+            )
+        log.info(
+            'Using DRBD resync-rate {} and max-buffers {} for {}'
+            .format(rate, max_buffers, self.vm_name)
+        )
+        return {'rate': rate, 'max_buffers': max_buffers}
+
+    @traced('drbd')
+    def measure_throughput(self, peer):
+        """Measure the throughput of the link and the disks in MiB/s
+
+        The destination volume is about to be overwritten by the replication,
+        so it is safe to write on it.
+        """
+        size_mib = min(
+            DRBD_PROBE_SIZE_MIB, self.get_device_size() // 1024 ** 2
+        )
+        port = peer.get_device_port()
+
+        peer.hv.check_netcat(port)
+        peer.hv.run(
+            'nohup /bin/nc.openbsd -l -p {} > /dev/null &'.format(port)
+        )
+        try:
+            link = parse_dd_rate(self.hv.run(
+                'LC_ALL=C dd if=/dev/zero bs=1M count={} '
+                '| /bin/nc.openbsd -q 1 {} {}'
+                .format(size_mib, peer.hv.dataset_obj['intern_ip'], port),
+                silent=True,
+            ))
+        except BaseException:
+            peer.hv.kill_netcat(port)
+            raise
+
+        read = parse_dd_rate(self.hv.run(
+            'LC_ALL=C dd if=/dev/{}/{} of=/dev/null bs=1M count={} '
+            'iflag=direct'
+            .format(self.vg_name, self.lv_name, size_mib),
+            silent=True,
+        ))
+        write = parse_dd_rate(peer.hv.run(
+            'LC_ALL=C dd if=/dev/zero of=/dev/{}/{} bs=1M count={} '
+            'oflag=direct'
+            .format(peer.vg_name, peer.lv_name, size_mib),
+            silent=True,
+        ))
+
+        return {'link': link, 'read': read, 'write': write}
+
     @contextmanager
-    def start(self, peer):
+    def start(self, peer, tuning):
         """Start the replication
 
         This is a context manager that would start the replication and stop
@@ -59,7 +143,9 @@ class DRBD(object):
         all the initialization steps are successfully completed.  Therefore,
         all of the initialization must handle cleaning up themselves.
         """
-        with self.prepare_metadata_device(), self.build_config(peer):
+        with span('drbd', 'start', host=self.hv.fqdn), \
+                self.prepare_metadata_device(), \
+                self.build_config(peer, tuning):
             if self.master_role:
                 self.replicate_to_slave()
             else:
@@ -69,20 +155,47 @@ class DRBD(object):
         finally:
             self.stop()
 
+    def get_metadata_size(self):
+        """Calculate the size of the external metadata in MiB
+
+        This is the formula from the DRBD documentation.  The bitmap takes
+        8 sectors for every 2^18 sectors of data, plus 72 sectors for the
+        superblock and the activity log.
+        """
+        data_sectors = self.get_device_size() // 512
+        meta_sectors = -(-data_sectors // 2 ** 18) * 8 + 72
+        return -(-meta_sectors * 512 // 1024 ** 2)
+
+    def zero_device(self, device, size_mib):
+        """Zero a device, preferably without writing all the zeroes
+
+        blkdiscard -z lets the device zero the blocks itself, if it supports
+        it.  We fall back to writing the zeroes with dd otherwise.
+        """
+        if self.hv.run(
+            'blkdiscard -z {}'.format(device), warn_only=True, silent=True
+        ).succeeded:
+            return
+        log.debug('blkdiscard is not supported on {}, using dd'.format(device))
+        self.hv.run(
+            'dd if=/dev/zero of={} bs=1048576 count={}'
+            .format(device, size_mib)
+        )
+
     @contextmanager
     def prepare_metadata_device(self):
         """Create and zero metadata device for DRBD"""
 
-        # 256MiB of metadata is fine up to 7TiB of synced storage.
+        # LVM rounds the size up to its extents
+        meta_size = self.get_metadata_size()
         self.hv.run(
-            'lvcreate -y -n {} -L256M {}'
-            .format(self.meta_disk, self.vg_name)
+            'lvcreate -y -n {} -L{}M {}'
+            .format(self.meta_disk, meta_size, self.vg_name)
         )
         try:
             # Meta device must be zeroed, otherwise DRBD might complain
-            self.hv.run(
-                'dd if=/dev/zero of=/dev/{}/{} bs=1048576 count=256'
-                .format(self.vg_name, self.meta_disk)
+            self.zero_device(
+                '/dev/{}/{}'.format(self.vg_name, self.meta_disk), meta_size
             )
             if self.master_role:
                 with self.prepare_lv_override():
@@ -117,16 +230,14 @@ class DRBD(object):
             raise
 
     @contextmanager
-    def build_config(self, peer):
+    def build_config(self, peer, tuning):
         fd = BytesIO()
         fd.write(
             'resource {dev} {{\n'
             '    net {{\n'
             '        protocol C;\n'
-            # max-buffers vs MB/s
-            # 4k-150, 8k-233, 12k-330, 16K-397, 24k-561, 32k-700
-            # 32k seems jumpy and might end up at as low aw 250MB/s
-            '        max-buffers 24k;\n'
+            # See DRBD_MAX_BUFFERS for how it relates to the resync rate
+            '        max-buffers {max_buffers};\n'
             # Buffer sizes don't seem to make any difference, at least within
             # one datacenter.
             '#        sndbuf-size 2048k;\n'
@@ -134,14 +245,16 @@ class DRBD(object):
             '    }}\n'
             '    disk {{\n'
             # Try maximum speed immediately, no need for the slow-start
-            '         c-max-rate 750M;\n'
-            '         resync-rate 750M;\n'
+            '         c-max-rate {rate};\n'
+            '         resync-rate {rate};\n'
             '    }}\n'
             '{src_host}\n'
             '{dst_host}\n'
             '}}\n'
             .format(
                 dev=self.vm_name,
+                max_buffers=tuning['max_buffers'],
+                rate=tuning['rate'],
                 src_host=self.get_host_config(),
                 dst_host=peer.get_host_config(),
             ).encode()
@@ -177,6 +290,7 @@ class DRBD(object):
             )
         )
 
+    @traced('drbd')
     def replicate_to_slave(self, transaction=None):
         # Size must be retrieved before suspending device
         dev_size = self.get_device_size()
@@ -186,16 +300,14 @@ class DRBD(object):
             'dmsetup suspend /dev/{}/{}'.format(self.vg_name, self.lv_name)
         )
         try:
-            # Start DRBD on device
-            self.hv.run('drbdadm create-md {}'.format(self.vm_name))
-            self.hv.run('drbdadm up {}'.format(self.vm_name))
-
-            # Enforce primary operation and sync to secondary with
-            # overwriting of data
-            self.hv.run(
+            # Start DRBD on device, then enforce primary operation and sync
+            # to secondary with overwriting of data
+            self.hv.run_batch([
+                'drbdadm create-md {}'.format(self.vm_name),
+                'drbdadm up {}'.format(self.vm_name),
                 'drbdadm -- --overwrite-data-of-peer primary {}'
-                .format(self.vm_name)
-            )
+                .format(self.vm_name),
+            ])
 
             # DRBD is finally up, now replace device which VM talks to on-fly.
             # In Device Mapper block is always 512 bytes.
@@ -240,61 +352,67 @@ class DRBD(object):
             )
             raise
 
+    @traced('drbd')
     def replicate_from_master(self, transaction=None):
-        self.hv.run('drbdadm create-md {}'.format(self.vm_name))
-        self.hv.run('drbdadm up {}'.format(self.vm_name))
+        self.hv.run_batch([
+            'drbdadm create-md {}'.format(self.vm_name),
+            'drbdadm up {}'.format(self.vm_name),
+        ])
         try:
             self.hv.run('drbdadm wait-connect {}'.format(self.vm_name))
         except BaseException:
             self.hv.run('drbdadm down {}'.format(self.vm_name))
             raise
 
+    @traced('drbd')
     def wait_for_sync(self):
-        # Display a "nice" progress bar
-        show_progress = True
-        retry = 5
-        while show_progress:
-            lines = iter(self.hv.read_file('/proc/drbd').splitlines())
-            for line in lines:
-                line = line.decode()
-                if '{}: cs:'.format(self.get_device_minor()) in line:
-                    if 'ds:UpToDate/UpToDate' in line:
-                        show_progress = False
-                    try:
-                        next(lines)
-                        line = next(lines).decode().lstrip()
-                    except StopIteration:
-                        if retry:
-                            log.info(
-                                'No status yet, trying {} more time'
-                                .format(retry)
-                            )
-                            retry -= 1
-                            break
-                        log.warning(
-                            'Could not find progress bar, '
-                            'migrating without it!'
-                        )
-                        show_progress = False
-                    else:
-                        log.info(line)
-                    break
-            else:
-                # Exit the loop if status for current device can't be found
-                show_progress = False
-            sleep(1)
+        """Follow the DRBD events of the resource until the peer is synced
 
-        # Progress bar does not determine if disks were synced.
-        # Wait for sync to be reported by DRBD.
-        self.hv.run('drbdsetup wait-sync {}'.format(self.get_device_minor()))
+        The events are streamed by a single long-lived "drbdsetup events2"
+        instead of downloading /proc/drbd every second.  It reports the
+        current state first, and the changes as they happen afterwards.  The
+        peer-device lines report the disk state of the peer as well, so
+        waiting on the master is enough to know that both sides are
+        up-to-date.  The statistics only come with the changes, so they are
+        also polled every DRBD_PROGRESS_INTERVAL seconds into the same
+        stream to report the progress steadily.  The poller stops when the
+        events stop.  The remote loop stops following the stream as soon as
+        the peer is synced, and fails if the stream ends before.  drbdsetup
+        is killed then, because it would only notice that nobody is reading
+        anymore with the next event.
+        """
+        progress = DRBDSyncProgress(self.vm_name, self.get_device_size())
+        self.hv.run(
+            'dir=$(mktemp -d); mkfifo $dir/events; '
+            'drbdsetup events2 --statistics {res} > $dir/events & pid=$!; '
+            'while sleep {interval} && kill -0 $pid 2>/dev/null; do '
+            'drbdsetup events2 --now --statistics {res} '
+            '| grep " peer-device "; '
+            'done > $dir/events 2>/dev/null & poll=$!; '
+            'rc=1; '
+            'while read -r line; do '
+            'echo "$line"; '
+            'case "$line" in '
+            '*" peer-device "*replication:Established*peer-disk:UpToDate*) '
+            'rc=0; break;; '
+            'esac; '
+            'done < $dir/events; '
+            'kill $pid $poll 2>/dev/null; rm -r $dir; exit $rc'
+            .format(res=self.vm_name, interval=DRBD_PROGRESS_INTERVAL),
+            silent=True,
+            stdout=progress,
+        )
+        progress.finish()
 
+    @traced('drbd')
     def stop(self):
+        commands = []
         if self.master_role:
-            self.hv.run(
+            commands.append(
                 'dmsetup load /dev/{}/{} < {}'
                 .format(self.vg_name, self.lv_name, self.table_file)
             )
-            self.hv.run('dmsetup resume /dev/{}/{}'.format(
+            commands.append('dmsetup resume /dev/{}/{}'.format(
                 self.vg_name, self.lv_name
             ))
 
@@ -305,10 +423,99 @@ class DRBD(object):
         # is fully updated. Do we risk data loss here? Probably yes. But since
         # we shut down source VM before DRBD is stopped and start the target VM
         # only after that, all is safe.
-        self.hv.run('drbdadm down {}'.format(self.vm_name))
+        commands.append('drbdadm down {}'.format(self.vm_name))
 
         if self.master_role:
-            self.hv.run('dmsetup remove {}_orig'.format(self.lv_name))
+            commands.append('dmsetup remove {}_orig'.format(self.lv_name))
+
+        commands.append(
+            'lvremove -fy {}/{}'.format(self.vg_name, self.meta_disk)
+        )
+        commands.append('rm /etc/drbd.d/{}.res'.format(self.vm_name))
+        self.hv.run_batch(commands)
+
+
+def parse_dd_rate(output):
+    """Parse the summary of dd to MiB/s"""
+    match = re.search(r'(\d+) bytes.* copied, ([\d.]+) s', output)
+    if not match:
+        raise ValueError('Cannot parse dd output "{}"'.format(output))
+    return int(match.group(1)) / 1024 ** 2 / max(float(match.group(2)), 0.001)
 
-        self.hv.run('lvremove -fy {}/{}'.format(self.vg_name, self.meta_disk))
-        self.hv.run('rm /etc/drbd.d/{}.res'.format(self.vm_name))
+
+class DRBDSyncProgress(object):
+    """File-like object to parse the output of "drbdsetup events2"
+
+    Fabric writes the output of the remote command into this object as it
+    arrives.  We collect complete lines, and log the progress of the sync
+    whenever a peer-device line with statistics comes in.
+    """
+    def __init__(self, resource, size):
+        self.resource = resource
+        self.size = size
+        self.buffer = ''
+        self.start = time()
+        self.last = None
+        self.rate = None
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode()
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self.parse_line(line.strip())
+
+    def flush(self):
+        pass
+
+    def parse_line(self, line):
+        # Fabric prefixes the lines with the host name
+        words = line.split()
+        if 'peer-device' not in words:
+            return
+        fields = dict(
+            w.split(':', 1) for w in words[words.index('peer-device') + 1:]
+            if ':' in w
+        )
+        if fields.get('name') != self.resource or 'out-of-sync' not in fields:
+            return
+
+        # DRBD reports the statistics in KiB
+        out_of_sync = int(fields['out-of-sync']) * 1024
+        synced = max(self.size - out_of_sync, 0)
+        now = time()
+        if self.last is not None and now > self.last[0]:
+            rate = (synced - self.last[1]) / (now - self.last[0])
+            # Smooth the rate to keep the ETA from jumping around
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = 0.7 * self.rate + 0.3 * rate
+        self.last = (now, synced)
+
+        if self.rate:
+            eta = '{:.0f}s'.format(out_of_sync / self.rate)
+        else:
+            eta = 'unknown'
+        log.info(
+            '{}: {} peer-disk:{}, synced {:.2f} of {:.2f} GiB '
+            '({:.1f}%), {:.1f} MiB/s, ETA {}'
+            .format(
+                self.resource,
+                fields.get('replication', 'unknown'),
+                fields.get('peer-disk', 'unknown'),
+                synced / 1024 ** 3,
+                self.size / 1024 ** 3,
+                100.0 * synced / self.size if self.size else 100.0,
+                (self.rate or 0) / 1024 ** 2,
+                eta,
+            )
+        )
+
+    def finish(self):
+        duration = time() - self.start
+        log.info(
+            '{}: synced {:.2f} GiB in {:.0f}s'
+            .format(self.resource, self.size / 1024 ** 3, duration)
+        )
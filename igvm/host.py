@@ -3,31 +3,49 @@
 Copyright (c) 2018 InnoGames GmbH
 """
 
+from contextlib import contextmanager
 from io import BytesIO
 from datetime import datetime
 
 import fabric.api
-import fabric.state
 from fabric.contrib import files
 from uuid import uuid4
 
 from paramiko import transport
 from igvm.exceptions import RemoteCommandError, InvalidStateError
 from igvm.settings import COMMON_FABRIC_SETTINGS
+from igvm.sshpool import close_connection, use_connection
+from igvm.tracing import span
 
 from adminapi.dataset import DatasetError
 
 
+# Printed after every command of a batch followed by its index and exit code
+BATCH_MARKER = '__igvm_batch_step__'
+
+
 def with_fabric_settings(fn):
     """Decorator to run a function with COMMON_FABRIC_SETTINGS."""
     def decorator(*args, **kwargs):
         with fabric.api.settings(**COMMON_FABRIC_SETTINGS):
             return fn(*args, **kwargs)
     decorator.__name__ = '{}_with_fabric'.format(fn.__name__)
+    decorator.__wrapped__ = fn
     decorator.__doc__ = fn.__doc__
     return decorator
 
 
+class CommandResult(str):
+    """Output of a single command of a batch like the results of Fabric"""
+    def __new__(cls, output, command, return_code):
+        result = super(CommandResult, cls).__new__(cls, output)
+        result.command = command
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        return result
+
+
 class Host(object):
     """A remote host on which commands can be executed."""
 
@@ -61,6 +79,7 @@ class Host(object):
         """Check if a given uid_name matches this host"""
         return uid_name.split('_', 1)[0] == str(self.dataset_obj['object_id'])
 
+    @contextmanager
     def fabric_settings(self, *args, **kwargs):
         """Builds a fabric context manager to run commands on this host."""
         settings = COMMON_FABRIC_SETTINGS.copy()
@@ -69,7 +88,9 @@ class Host(object):
             'host_string': str(self.dataset_obj['intern_ip']),
         })
         settings.update(kwargs)
-        return fabric.api.settings(*args, **settings)
+        with use_connection(settings['host_string']), \
+                fabric.api.settings(*args, **settings):
+            yield
 
     def run(self, *args, **kwargs):
         """Runs a command on the remote host.
@@ -87,7 +108,11 @@ class Host(object):
             if setting in kwargs:
                 del kwargs[setting]
 
-        with self.fabric_settings(*settings, warn_only=warn_only):
+        command = str(args[0] if args else kwargs.get('command', ''))
+        with self.fabric_settings(*settings, warn_only=warn_only), span(
+            'ssh', (command.split(None, 1) or [''])[0],
+            host=self.fqdn, command=command[:200],
+        ):
             try:
                 if with_sudo:
                     return fabric.api.sudo(*args, **kwargs)
@@ -95,14 +120,65 @@ class Host(object):
                     return fabric.api.run(*args, **kwargs)
             except transport.socket.error:
                 # Retry once if connection was lost
-                host = fabric.api.env.host_string
-                if host and host in fabric.state.connections:
-                    fabric.state.connections[host].get_transport().close()
+                close_connection(fabric.api.env.host_string)
                 if with_sudo:
                     return fabric.api.sudo(*args, **kwargs)
                 else:
                     return fabric.api.run(*args, **kwargs)
 
+    def run_batch(self, commands, warn_only=False, silent=False,
+                  with_sudo=True):
+        """Runs a sequence of commands in a single remote shell
+
+        This saves a round-trip for every command.  The commands are run
+        one after another like in a script, and a line with the exit code is
+        printed after every one of them.  The execution stops at the first
+        failing command and RemoteCommandError is raised for it, unless
+        warn_only is set.  The output of the commands is returned as list
+        of results similar to the ones of run().
+        """
+        commands = list(commands)
+        script = []
+        for index, command in enumerate(commands):
+            script.append(command)
+            # The marker must start its own line, even if the output of
+            # the command doesn't end with a newline.  The extra empty line
+            # is stripped from the output.
+            script.append(
+                'igvm_rc=$?; echo; echo "{} {} $igvm_rc"'
+                .format(BATCH_MARKER, index)
+            )
+            if not warn_only:
+                script.append('[ $igvm_rc -eq 0 ] || exit 0')
+        output = self.run(
+            '\n'.join(script), silent=silent, with_sudo=with_sudo
+        )
+
+        results = []
+        lines = []
+        for line in output.splitlines():
+            if not line.startswith(BATCH_MARKER + ' '):
+                lines.append(line)
+                continue
+            index, return_code = (int(w) for w in line.split()[1:3])
+            result = CommandResult(
+                '\n'.join(lines).strip(), commands[index], return_code
+            )
+            lines = []
+            results.append(result)
+            if result.failed and not warn_only:
+                raise RemoteCommandError(
+                    'Command "{}" failed on "{}" with exit code {}: {}'
+                    .format(result.command, self, return_code, result)
+                )
+        if len(results) < len(commands) and not warn_only:
+            raise RemoteCommandError(
+                'Batch on "{}" stopped before command "{}"'
+                .format(self, commands[len(results)])
+            )
+
+        return results
+
     def file_exists(self, *args, **kwargs):
         """Run a fabric.contrib.files.exists on this host with sudo."""
         with self.fabric_settings():
@@ -110,9 +186,7 @@ class Host(object):
                 return files.exists(*args, **kwargs)
             except transport.socket.error:
                 # Retry once if connection was lost
-                host = fabric.api.env.host_string
-                if host and host in fabric.state.connections:
-                    fabric.state.connections[host].get_transport().close()
+                close_connection(fabric.api.env.host_string)
                 return files.exists(*args, **kwargs)
 
     def read_file(self, path):
@@ -3,12 +3,23 @@
 Copyright (c) 2018 InnoGames GmbH
 """
 
+from collections import Counter
 from contextlib import contextmanager
+from hashlib import sha256
+from io import BytesIO
+import json
 import logging
 import math
-from time import sleep
-
-from libvirt import VIR_DOMAIN_SHUTOFF
+from os import makedirs, path, remove
+from time import sleep, time
+
+from libvirt import (
+    VIR_DOMAIN_SHUTOFF,
+    VIR_DOMAIN_STATS_BALLOON,
+    VIR_DOMAIN_STATS_BLOCK,
+    VIR_DOMAIN_STATS_STATE,
+    VIR_DOMAIN_STATS_VCPU,
+)
 from xml.etree import ElementTree
 
 from igvm.exceptions import (
@@ -18,8 +29,10 @@ from igvm.exceptions import (
     InvalidStateError,
     StorageError,
 )
+from igvm.basevolume import BaseVolume
 from igvm.drbd import DRBD
 from igvm.host import Host
+from igvm.imagecache import ImageCache
 from igvm.kvm import (
     DomainProperties,
     generate_domain_xml,
@@ -30,15 +43,23 @@ from igvm.kvm import (
 from igvm.libvirt import get_virtconn
 from igvm.settings import (
     HOST_RESERVED_MEMORY,
+    HYPERVISOR_FACTS_CACHE_DIR,
+    HYPERVISOR_FACTS_TTL,
     VG_NAME,
     RESERVED_DISK,
-    IGVM_IMAGE_URL,
-    IGVM_IMAGE_MD5_URL,
-    IMAGE_PATH,
     MIGRATE_CONFIG,
     KVM_HWMODEL_TO_CPUMODEL,
+    NETCAT_COMPRESS,
+    NETCAT_DECOMPRESS,
+    NETCAT_DIFF_BLOCK_SIZE,
+    NETCAT_PARALLEL_MAX_STREAMS,
+    NETCAT_PARALLEL_PORT_BASE,
+    NETCAT_PARALLEL_PORT_MAX,
+    NETCAT_PARALLEL_STREAMS,
+    OFFLINE_TRANSPORTS,
     VM_OVERHEAD_MEMORY,
 )
+from igvm.tracing import traced
 from igvm.utils import retry_wait_backoff
 
 log = logging.getLogger(__name__)
@@ -58,45 +79,249 @@ class Hypervisor(Host):
 
         self._mount_path = {}
         self._storage_pool = None
-        self._storage_type = None
+        self._storage_pool_conn = None
+        self._facts = None
+        self._domain_index = None
+        self._domain_index_conn = None
+        self._domain_stats = None
+        self._domain_stats_conn = None
+        self._volume_index = None
+        self._volumes = {}
+        self._volume_sizes = None
+        # Number of libvirt calls avoided by the volume index
+        self.volume_lookups_saved = 0
+        self._vms_aggregates = {}
+        # VMs planned to be placed on this hypervisor, but not built yet
+        self.planned_vms = []
+
+    def copy(self):
+        """Return a copy of the hypervisor without the cached libvirt state
+
+        The checks done on the copy don't leave anything behind for the
+        later checks on this object.  Only the facts, which rarely change,
+        and the planned VMs are shared.
+        """
+        hypervisor = Hypervisor(self.dataset_obj)
+        hypervisor._facts = self._facts
+        hypervisor.planned_vms = self.planned_vms
+        return hypervisor
+
+    def acquire_lock(self, allow_fail=False):
+        super(Hypervisor, self).acquire_lock(allow_fail)
+        # Another igvm might have changed the domains and the volumes while
+        # we didn't hold the lock, so the checks after locking must not use
+        # what we have seen before.
+        self._invalidate_domain_index()
+        self._invalidate_volume_index()
 
     def get_storage_pool(self):
         # Store per-VM path information
         # We cannot store these in the VM object due to migrations.
-        if self._storage_pool:
+        # The handle is only valid as long as the connection, which might
+        # have been reopened after it died.
+        conn = self.conn()
+        if self._storage_pool and self._storage_pool_conn is conn:
             return self._storage_pool
-        self._storage_pool = self.conn().storagePoolLookupByName(VG_NAME)
+        self._invalidate_volume_index()
+        self._storage_pool = conn.storagePoolLookupByName(VG_NAME)
+        self._storage_pool_conn = conn
         return self._storage_pool
 
-    def get_storage_type(self):
-        if self._storage_type:
-            return self._storage_type
+    def get_facts(self):
+        """Return the facts of the hypervisor that rarely change
 
-        self._storage_type = ElementTree.fromstring(
-            self.get_storage_pool().XMLDesc()
-        ).attrib['type']
+        They are loaded once and kept for HYPERVISOR_FACTS_TTL seconds.
+        If HYPERVISOR_FACTS_CACHE_DIR is set, they are also stored there to
+        be shared between igvm invocations.  They are loaded only through
+        libvirt, so they can be reloaded from any thread.
+        """
+        if (
+            self._facts is None or
+            time() - self._facts['loaded_at'] > HYPERVISOR_FACTS_TTL
+        ):
+            self._facts = self._read_facts_cache()
+        if self._facts is None:
+            self._facts = self._load_facts()
+            self._write_facts_cache(self._facts)
+        return self._facts
+
+    def invalidate_facts(self):
+        """Forget the facts, for example after upgrading the hypervisor"""
+        self._facts = None
+        cache_file = self._facts_cache_file()
+        if cache_file and path.exists(cache_file):
+            remove(cache_file)
+
+    def _load_facts(self):
+        conn = self.conn()
+        # According to documentation the version is
+        # major * 1,000,000 + minor * 1,000 + release
+        version = conn.getVersion()
+        pool_xml = ElementTree.fromstring(self.get_storage_pool().XMLDesc())
+        capabilities_xml = ElementTree.fromstring(conn.getCapabilities())
+
+        return {
+            'loaded_at': time(),
+            'qemu_version': [
+                version // 1000000 % 1000000,
+                version // 1000 % 1000,
+                version % 1000,
+            ],
+            'num_numa_nodes': conn.getInfo()[4],
+            # Which physical CPU belongs to which physical node
+            'numa_cpulists': [
+                ','.join(c.attrib['id'] for c in cell.findall('cpus/cpu'))
+                for cell in sorted(
+                    capabilities_xml.findall('host/topology/cells/cell'),
+                    key=lambda cell: int(cell.attrib['id']),
+                )
+            ],
+            # What OS sees as total memory (not installed memory)
+            'total_memory_kib': conn.getMemoryStats(-1)['total'],
+            'storage_type': pool_xml.attrib['type'],
+            'storage_pool_path': pool_xml.findtext('target/path'),
+        }
+
+    def _facts_cache_file(self):
+        if not HYPERVISOR_FACTS_CACHE_DIR:
+            return None
+        return path.join(
+            path.expanduser(HYPERVISOR_FACTS_CACHE_DIR),
+            '{}.json'.format(self.fqdn),
+        )
 
+    def _read_facts_cache(self):
+        cache_file = self._facts_cache_file()
+        if not cache_file or not path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file) as fd:
+                facts = json.load(fd)
+        except (OSError, ValueError) as error:
+            log.warning(
+                'Ignoring facts cache "{}": {}'.format(cache_file, error)
+            )
+            return None
+        if time() - facts.get('loaded_at', 0) > HYPERVISOR_FACTS_TTL:
+            return None
+        return facts
+
+    def _write_facts_cache(self, facts):
+        cache_file = self._facts_cache_file()
+        if not cache_file:
+            return
+        try:
+            makedirs(path.dirname(cache_file), exist_ok=True)
+            with open(cache_file, 'w') as fd:
+                json.dump(facts, fd)
+        except OSError as error:
+            log.warning(
+                'Cannot write facts cache "{}": {}'.format(cache_file, error)
+            )
+
+    def get_storage_type(self):
+        storage_type = self.get_facts()['storage_type']
         if (
-            self._storage_type not in HOST_RESERVED_MEMORY or
-            self._storage_type not in RESERVED_DISK
+            storage_type not in HOST_RESERVED_MEMORY or
+            storage_type not in RESERVED_DISK
         ):
             raise HypervisorError(
                 'Unsupported storage type {} on hypervisor {}'
-                .format(self._storage_type, self.dataset_obj['hostname'])
+                .format(storage_type, self.dataset_obj['hostname'])
+            )
+        return storage_type
+
+    def _get_volume_index(self):
+        """Return the volume names of the storage pool indexed by prefix
+
+        The prefix is the part of the volume name before the first
+        underscore, which is the object_id for the volumes with an uid_name.
+        The index is kept until the storage pool is changed by us.
+        """
+        if self._volume_index is None:
+            index = {}
+            for vol_name in self.get_storage_pool().listVolumes():
+                index.setdefault(vol_name.split('_', 1)[0], []).append(
+                    vol_name
+                )
+            self._volume_index = index
+            self._volumes = {}
+        else:
+            self.volume_lookups_saved += 1
+        return self._volume_index
+
+    def _invalidate_volume_index(self):
+        """Forget the volume index after changing the storage pool"""
+        if self._volume_index is not None:
+            log.debug(
+                'Dropping volume index of "{}", {} lookups saved so far'
+                .format(self.fqdn, self.volume_lookups_saved)
+            )
+        self._volume_index = None
+        self._volumes = {}
+        self._volume_sizes = None
+
+    def get_volume_sizes(self):
+        """Return the sizes of all volumes of the storage pool in bytes
+
+        On LVM we get them with a single command instead of asking libvirt
+        for every volume.  They are kept as long as the volume index.
+        """
+        if self._volume_sizes is None:
+            if self.get_storage_type() == 'logical':
+                self._volume_sizes = {
+                    name: int(size)
+                    for name, size in (
+                        line.split() for line in self.run(
+                            'lvs --noheadings --units b --nosuffix '
+                            '-o lv_name,lv_size {}'.format(VG_NAME),
+                            silent=True,
+                        ).splitlines()
+                        if line.strip()
+                    )
+                }
+            else:
+                self._volume_sizes = {
+                    v.name(): v.info()[1]
+                    for v in self.get_storage_pool().listAllVolumes()
+                }
+        return self._volume_sizes
+
+    def _lookup_volume(self, vol_name):
+        if vol_name in self._volumes:
+            self.volume_lookups_saved += 1
+        else:
+            self._volumes[vol_name] = (
+                self.get_storage_pool().storageVolLookupByName(vol_name)
             )
-        return self._storage_type
+        return self._volumes[vol_name]
+
+    def _delete_volume(self, volume):
+        volume.delete()
+        self._invalidate_volume_index()
 
     def get_volume_by_vm(self, vm):
         """Get logical volume information of a VM"""
+        return self._lookup_volume(self._get_volume_name_by_vm(vm))
+
+    def _get_volume_name_by_vm(self, vm):
+        index = self._get_volume_index()
+
+        # Match the LV based on the object_id encoded within its name
+        vol_names = index.get(str(vm.dataset_obj['object_id']))
+        if vol_names:
+            # Prefer the current one over a stale volume of the VM left
+            # behind under another name
+            if vm.uid_name in vol_names:
+                return vm.uid_name
+            return vol_names[0]
+
+        # XXX: Deprecated matching for LVs w/o an uid_name
         domain = self._find_domain(vm)
-        for vol_name in self.get_storage_pool().listVolumes():
-            if (
-                # Match the LV based on the object_id encoded within its name
-                vm.match_uid_name(vol_name) or
-                # XXX: Deprecated matching for LVs w/o an uid_name
-                domain and vol_name == domain.name()
-            ):
-                return self.get_storage_pool().storageVolLookupByName(vol_name)
+        if domain:
+            for vol_name in index.get(domain.name().split('_', 1)[0], []):
+                if vol_name == domain.name():
+                    return vol_name
 
         raise StorageError(
             'No existing storage volume found for VM "{}" on "{}".'
@@ -124,6 +349,7 @@ class Hypervisor(Host):
                     )
                 )
                 self.get_storage_pool().refresh()
+                self._invalidate_volume_index()
 
     def vm_mount_path(self, vm):
         """Returns the mount path for a VM or raises HypervisorError if not
@@ -135,6 +361,47 @@ class Hypervisor(Host):
             )
         return self._mount_path[vm]
 
+    def _vms_with_planned(self):
+        return list(self.dataset_obj['vms']) + [
+            v.dataset_obj for v in self.planned_vms
+        ]
+
+    def plan_vm(self, vm):
+        """Account a VM to be built on this hypervisor
+
+        The planned VMs are counted as if they were already on
+        the hypervisor by the VM aggregates, and their resources are not
+        reported as free anymore.
+        """
+        self.planned_vms.append(vm)
+        self._vms_aggregates = {}
+
+    def vms_total(self, attribute):
+        """Sum up an attribute of the VMs on the hypervisor on Serveradmin
+
+        The hypervisor preferences need the same sums for every VM placed,
+        so we are calculating them only once.
+        """
+        key = ('total', attribute)
+        if key not in self._vms_aggregates:
+            self._vms_aggregates[key] = sum(
+                v[attribute] for v in self._vms_with_planned()
+            )
+        return self._vms_aggregates[key]
+
+    def vms_counter(self, attributes):
+        """Count the VMs on the hypervisor by the values of the attributes
+
+        Returns a Counter keyed by the tuple of the attribute values.
+        """
+        key = ('counter', tuple(attributes))
+        if key not in self._vms_aggregates:
+            self._vms_aggregates[key] = Counter(
+                tuple(v[a] for a in attributes)
+                for v in self._vms_with_planned()
+            )
+        return self._vms_aggregates[key]
+
     def get_vlan_network(self, ip_addr):
         """Find the network for the VM
 
@@ -232,16 +499,23 @@ class Hypervisor(Host):
                 .format(self.fqdn, vm.route_network)
             )
 
-    def define_vm(self, vm, transaction=None):
-        """Creates a VM on the hypervisor."""
+    def define_vm(self, vm, transaction=None, domain_xml=None):
+        """Creates a VM on the hypervisor.
+
+        The domain XML is generated, unless it is given.
+        """
         log.info('Defining "{}" on "{}"...'.format(vm.fqdn, self.fqdn))
 
-        self.conn().defineXML(generate_domain_xml(self, vm))
+        if domain_xml is None:
+            domain_xml = generate_domain_xml(self, vm)
+        self.conn().defineXML(domain_xml)
+        self._invalidate_domain_index()
 
         # Refresh storage pools to register the vm image
         for pool_name in self.conn().listStoragePools():
             pool = self.conn().storagePoolLookupByName(pool_name)
             pool.refresh(0)
+        self._invalidate_volume_index()
         if transaction:
             transaction.on_rollback(
                 'delete VM', self.undefine_vm, vm, keep_storage=True
@@ -286,6 +560,7 @@ class Hypervisor(Host):
             self.redefine_vm(vm)
         else:
             set_vcpus(self, vm, self._get_domain(vm), num_cpu)
+            self._invalidate_domain_stats()
 
         # Validate changes
         # We can't rely on the hypervisor to provide data on VMs all the time.
@@ -330,6 +605,7 @@ class Hypervisor(Host):
         else:
             old_total = vm.meminfo()['MemTotal']
             set_memory(self, vm, self._get_domain(vm))
+            self._invalidate_domain_stats()
             vm.dataset_obj.commit()
 
             # Hypervisor might take some time to propagate memory changes,
@@ -363,6 +639,7 @@ class Hypervisor(Host):
             # available in Debian 9.
             self.run('lvresize {} -L {}g'.format(volume.path(), new_size_gib))
             self.get_storage_pool().refresh()
+            self._invalidate_volume_index()
         else:
             raise NotImplementedError(
                 'Storage volume resizing is supported only on LVM storage!'
@@ -371,11 +648,33 @@ class Hypervisor(Host):
             'vda',
             new_size_gib * 1024 ** 2,  # Yes, it is in KiB
         )
+        self._invalidate_domain_stats()
         vm.run('xfs_growfs /')
 
+    def remove_stale_volumes(self, vm):
+        """Remove the volumes left behind for the VM on this hypervisor
+
+        They are left by vm_migrate with keep_source_storage for the
+        netcat_diff transport to reuse.  They are in the way of creating
+        the storage of the VM here again for anything else.
+        """
+        if self.vm_defined(vm):
+            raise InvalidStateError(
+                'Refusing to remove volumes of defined VM "{}".'
+                .format(vm.fqdn)
+            )
+        index = self._get_volume_index()
+        for vol_name in list(index.get(str(vm.dataset_obj['object_id']), [])):
+            log.warning(
+                'Removing stale volume "{}" of "{}" from "{}"'
+                .format(vol_name, vm.fqdn, self.fqdn)
+            )
+            self._delete_volume(self._lookup_volume(vol_name))
+
     def create_vm_storage(self, vm, transaction=None, vol_name=None):
         """Allocate storage for a VM. Returns the disk path."""
         vol_name = vm.uid_name if vol_name is None else vol_name
+        self.remove_stale_volumes(vm)
         volume_xml = """
             <volume>
                 <name>{name}</name>
@@ -388,6 +687,7 @@ class Hypervisor(Host):
         )
 
         volume = self.get_storage_pool().createXML(volume_xml, 0)
+        self._invalidate_volume_index()
         if volume is None:
             raise StorageError(
                 'Failed to create storage volume {}/{}'.format(
@@ -397,7 +697,9 @@ class Hypervisor(Host):
             )
 
         if transaction:
-            transaction.on_rollback('destroy storage', volume.delete)
+            transaction.on_rollback(
+                'destroy storage', self._delete_volume, volume
+            )
 
         # XXX: When building a VM we use the volumes path to format it right
         # after creation.  Unfortunately the kernel is slow to pick up on zfs
@@ -417,32 +719,60 @@ class Hypervisor(Host):
         self.format_storage(self.get_volume_by_vm(vm).path())
         return self.mount_vm_storage(vm, transaction)
 
+    def clone_vm_storage(self, vm, image, transaction=None):
+        """Create storage for VM from the base volume of the image
+
+        This replaces creating, formatting and extracting the image into the
+        storage.  Returns mount path.
+        """
+        if self.vm_defined(vm):
+            raise InvalidStateError(
+                'Refusing to clone storage of defined VM "{}".'
+                .format(vm.fqdn)
+            )
+
+        base_volume = BaseVolume(self, image)
+        base_volume.ensure()
+        log.info('Cloning base volume {} for "{}" with {}'.format(
+            base_volume.name, vm.fqdn, base_volume.get_clone_method()
+        ))
+        if base_volume.get_clone_method() == 'xfs_copy':
+            self.create_vm_storage(vm, transaction)
+            base_volume.copy_to(self.get_volume_by_vm(vm).path())
+        else:
+            self.remove_stale_volumes(vm)
+            base_volume.clone(vm.uid_name, vm.dataset_obj['disk_size_gib'])
+            if transaction:
+                transaction.on_rollback(
+                    'destroy storage',
+                    self._remove_clone,
+                    base_volume,
+                    vm.uid_name,
+                )
+            # The volume was created behind the back of libvirt
+            self.get_storage_pool().refresh()
+            self._invalidate_volume_index()
+
+        mount_path = self.mount_vm_storage(vm, transaction)
+        self.run('xfs_growfs {}'.format(mount_path), silent=True)
+        return mount_path
+
+    def _remove_clone(self, base_volume, vol_name):
+        base_volume.remove_clone(vol_name)
+        self.get_storage_pool().refresh()
+        self._invalidate_volume_index()
+
     def download_and_extract_image(self, image, target_dir):
-        """Download image, verify its checsum and extract it
+        """Extract the image from the image cache of the hypervisor
 
-        All operations must be performed with locking, so that parallel
-        running igvm won't touch eachothers' images.
+        The image is only downloaded, when it is not in the cache or
+        changed on the image server.
         """
+        ImageCache(self).extract(image, target_dir)
 
-        self.run(
-            '( '
-            'set -e ; '
-            'flock -w 120 9 ; '
-            'curl -o {img_path}/{img_file}.md5 {md5_url} ; '
-            'sed -Ei \'s_ (.*/)?([a-zA-Z0-9\.\-]+)$_ {img_path}/\\2_\' '
-            '{img_path}/{img_file}.md5 ; '
-            'md5sum -c {img_path}/{img_file}.md5 || '
-            'curl -o {img_path}/{img_file} {img_url} ; '
-            'tar --xattrs --xattrs-include=\'*\' -xzf {img_path}/{img_file} '
-            '-C {dst_path} ;'
-            ') 9>/tmp/igvm_image.lock'.format(
-                img_path=IMAGE_PATH,
-                img_file=image,
-                img_url=IGVM_IMAGE_URL.format(image=image),
-                md5_url=IGVM_IMAGE_MD5_URL.format(image=image),
-                dst_path=target_dir,
-            )
-        )
+    def prefetch_image(self, image):
+        """Download the image into the image cache of the hypervisor"""
+        ImageCache(self).prefetch(image)
 
     def mount_vm_storage(self, vm, transaction=None):
         """Mount VM filesystem on host and return mount point."""
@@ -480,9 +810,9 @@ class Hypervisor(Host):
         # Update disk size
         result = {}
         try:
-            vol_size = self.get_volume_by_vm(vm).info()[1]
+            vol_size = self.get_volume_sizes()[self._get_volume_name_by_vm(vm)]
             result['disk_size_gib'] = int(math.ceil(vol_size / 1024 ** 3))
-        except HypervisorError:
+        except (HypervisorError, KeyError):
             raise HypervisorError(
                 'Unable to find source LV and determine its size.'
             )
@@ -501,7 +831,35 @@ class Hypervisor(Host):
 
     def num_numa_nodes(self):
         """Return the number of NUMA nodes"""
-        return self.conn().getInfo()[4]
+        return self.get_facts()['num_numa_nodes']
+
+    def _get_domain_index(self):
+        """Return the domains on the hypervisor indexed by name prefix
+
+        Listing the domains and asking their names are a round-trip to
+        the hypervisor each.  We are doing this only once and keep the
+        domain handles indexed by the part of their name before the first
+        underscore, which is the object_id for the domains with an uid_name.
+        The index is bound to the connection it is built from, so it is
+        rebuilt after reconnecting.
+        """
+        conn = self.conn()
+        if self._domain_index is None or self._domain_index_conn is not conn:
+            index = {}
+            for domain in conn.listAllDomains():
+                name = domain.name()
+                index.setdefault(name.split('_', 1)[0], []).append(
+                    (name, domain)
+                )
+            self._domain_index = index
+            self._domain_index_conn = conn
+        return self._domain_index
+
+    def _invalidate_domain_index(self):
+        """Forget the domain index after defining or undefining domains"""
+        self._domain_index = None
+        self._domain_index_conn = None
+        self._invalidate_domain_stats()
 
     def _find_domain(self, vm):
         """Search and return the domain on hypervisor
@@ -509,26 +867,23 @@ class Hypervisor(Host):
         It is erroring out when multiple domains found, and returning None,
         when none found.
         """
-        found = None
-        # We are not using lookupByName(), because it prints ugly messages to
-        # the console.
-        for domain in self.conn().listAllDomains():
-            name = domain.name()
-            if not (
-                # Match the domain based on the object_id encoded in its name
-                vm.match_uid_name(name) or
-                # XXX: Deprecated matching for domains w/o an uid_name
+        index = self._get_domain_index()
+
+        # Match the domain based on the object_id encoded in its name
+        candidates = list(index.get(str(vm.dataset_obj['object_id']), []))
+        # XXX: Deprecated matching for domains w/o an uid_name
+        for name, domain in (d for ds in index.values() for d in ds):
+            if (
                 vm.fqdn == name or vm.fqdn.startswith(name + '.')
-            ):
-                continue
+            ) and not vm.match_uid_name(name):
+                candidates.append((name, domain))
 
-            if found is not None:
-                raise HypervisorError(
-                    'Same VM is defined multiple times as "{}" and "{}".'
-                    .format(found.name(), name)
-                )
-            found = domain
-        return found
+        if len(candidates) > 1:
+            raise HypervisorError(
+                'Same VM is defined multiple times as "{}" and "{}".'
+                .format(candidates[0][0], candidates[1][0])
+            )
+        return candidates[0][1] if candidates else None
 
     def _get_domain(self, vm):
         domain = self._find_domain(vm)
@@ -546,9 +901,9 @@ class Hypervisor(Host):
 
     def migrate_vm(
         self, vm, target_hypervisor, offline, offline_transport, transaction,
-        no_shutdown,
+        no_shutdown, drbd_rate=None, drbd_max_buffers=None,
     ):
-        if offline_transport not in ['netcat', 'drbd']:
+        if offline_transport not in OFFLINE_TRANSPORTS:
             raise StorageError(
                 'Unknown offline transport method {}!'
                 .format(offline_transport)
@@ -559,7 +914,10 @@ class Hypervisor(Host):
                 'Starting offline migration of vm {} from {} to {}'.format(
                     vm, vm.hypervisor, target_hypervisor)
             )
-            target_hypervisor.create_vm_storage(vm, transaction)
+            reused = target_hypervisor._prepare_offline_storage(
+                vm, offline_transport, transaction
+            )
+
             if offline_transport == 'drbd':
                 if (
                     self.get_storage_type() != 'logical' or
@@ -589,10 +947,12 @@ class Hypervisor(Host):
                         src_block_size,
                         dst_block_size,
                     ))
-                with host_drbd.start(peer_drbd), peer_drbd.start(host_drbd):
-                    # XXX: Do we really need to wait for the both?
+                tuning = host_drbd.get_tuning(
+                    peer_drbd, drbd_rate, drbd_max_buffers
+                )
+                with host_drbd.start(peer_drbd, tuning), \
+                        peer_drbd.start(host_drbd, tuning):
                     host_drbd.wait_for_sync()
-                    peer_drbd.wait_for_sync()
                     vm.set_state('maintenance', transaction=transaction)
 
                     if vm.is_running():
@@ -605,7 +965,7 @@ class Hypervisor(Host):
                                 transaction=transaction,
                             )
 
-            elif offline_transport == 'netcat':
+            else:
                 vm.set_state('maintenance', transaction=transaction)
                 if vm.is_running():
                     if no_shutdown:
@@ -617,13 +977,9 @@ class Hypervisor(Host):
                             transaction=transaction,
                         )
 
-                vm_disk_path = target_hypervisor.get_volume_by_vm(vm).path()
-                with target_hypervisor.netcat_to_device(vm_disk_path) as args:
-                    self.device_to_netcat(
-                        self.get_volume_by_vm(vm).path(),
-                        vm.dataset_obj['disk_size_gib'] * 1024 ** 3,
-                        args,
-                    )
+                self._copy_vm_disk(
+                    vm, target_hypervisor, offline_transport, reused
+                )
             target_hypervisor.define_vm(vm, transaction)
         else:
             # For online migrations always use same volume name as VM
@@ -634,10 +990,58 @@ class Hypervisor(Host):
             )
             migrate_live(self, target_hypervisor, vm, self._get_domain(vm))
 
+    def _prepare_offline_storage(self, vm, offline_transport, transaction):
+        """Create the storage of the VM for an offline migration to here
+
+        The netcat_diff transport reuses a stale volume of the VM of the same
+        size instead.  Returns whether it did.  The other stale volumes are
+        removed by create_vm_storage().
+        """
+        if (
+            offline_transport == 'netcat_diff' and
+            self.get_stale_volume(vm) is not None
+        ):
+            return True
+        self.create_vm_storage(vm, transaction)
+        return False
+
+    def _copy_vm_disk(self, vm, target_hypervisor, offline_transport, diff):
+        """Copy the disk of the VM with one of the netcat transports"""
+        source_path = self.get_volume_by_vm(vm).path()
+        target_path = target_hypervisor.get_volume_by_vm(vm).path()
+        if diff:
+            self.copy_device_diff(source_path, target_hypervisor, target_path)
+            return
+        if offline_transport == 'netcat_parallel':
+            self.copy_device_parallel(
+                source_path,
+                target_hypervisor,
+                target_path,
+                vm.dataset_obj['disk_size_gib'] * 1024,
+            )
+            return
+
+        compress = offline_transport == 'netcat_zstd'
+        with target_hypervisor.netcat_to_device(
+            target_path,
+            compress=compress,
+            # Fresh ZFS volumes are read as zeroes, we can skip writing
+            # them.  LVM ones may contain anything.
+            sparse=(
+                compress and target_hypervisor.get_storage_type() == 'zfs'
+            ),
+        ) as args:
+            self.device_to_netcat(
+                source_path,
+                vm.dataset_obj['disk_size_gib'] * 1024 ** 3,
+                args,
+                compress=compress,
+            )
+
     def total_vm_memory(self):
         """Get amount of memory in MiB available to hypervisor"""
         # Start with what OS sees as total memory (not installed memory)
-        total_mib = self.conn().getMemoryStats(-1)['total'] // 1024
+        total_mib = self.get_facts()['total_memory_kib'] // 1024
         # Always keep some extra memory free for Hypervisor
         total_mib -= HOST_RESERVED_MEMORY[self.get_storage_type()]
         return total_mib
@@ -649,14 +1053,17 @@ class Hypervisor(Host):
         # Calculate memory used by other VMs.
         # We can not trust conn().getFreeMemory(), sum up memory used by
         # each VM instead
-        used_kib = 0
-        for dom in self.conn().listAllDomains():
-            used_kib += dom.info()[2]
+        used_kib = sum(
+            stats.get('balloon.current', 0)
+            for stats in self.get_domain_stats().values()
+        )
         free_mib = total_mib - (used_kib / 1024 - VM_OVERHEAD_MEMORY)
+        free_mib -= sum(v.dataset_obj['memory'] for v in self.planned_vms)
         return free_mib
 
     def start_vm(self, vm):
         log.info('Starting "{}" on "{}"...'.format(vm.fqdn, self.fqdn))
+        self._invalidate_domain_stats()
         if self._get_domain(vm).create() != 0:
             raise HypervisorError('"{0}" failed to start'.format(vm.fqdn))
 
@@ -677,11 +1084,13 @@ class Hypervisor(Host):
 
     def stop_vm(self, vm):
         log.info('Shutting down "{}" on "{}"...'.format(vm.fqdn, self.fqdn))
+        self._invalidate_domain_stats()
         if self._get_domain(vm).shutdown() != 0:
             raise HypervisorError('Unable to stop "{}".'.format(vm.fqdn))
 
     def stop_vm_force(self, vm):
         log.info('Force-stopping "{}" on "{}"...'.format(vm.fqdn, self.fqdn))
+        self._invalidate_domain_stats()
         if self._get_domain(vm).destroy() != 0:
             raise HypervisorError(
                 'Unable to force-stop "{}".'.format(vm.fqdn)
@@ -697,9 +1106,11 @@ class Hypervisor(Host):
         if not keep_storage:
             # XXX: get_volume_by_vm depends on domain names to find legacy
             # domains w/o an uid_name.  The order is therefore important.
-            self.get_volume_by_vm(vm).delete()
+            self._delete_volume(self.get_volume_by_vm(vm))
 
-        if self._get_domain(vm).undefine() != 0:
+        domain = self._get_domain(vm)
+        self._invalidate_domain_index()
+        if domain.undefine() != 0:
             raise HypervisorError('Unable to undefine "{}".'.format(vm.fqdn))
 
     def redefine_vm(self, vm, new_fqdn=None):
@@ -713,16 +1124,54 @@ class Hypervisor(Host):
         self.define_vm(vm)
 
     def _vm_sync_from_hypervisor(self, vm, result):
-        vm_info = self._get_domain(vm).info()
+        stats = self.get_vm_stats(vm)
 
-        mem = int(vm_info[2] / 1024)
+        mem = int(stats.get('balloon.current', 0) / 1024)
         if mem > 0:
             result['memory'] = mem
 
-        num_cpu = vm_info[3]
+        num_cpu = stats.get('vcpu.current', 0)
         if num_cpu > 0:
             result['num_cpu'] = num_cpu
 
+    def get_domain_stats(self):
+        """Return the statistics of all domains keyed by their names
+
+        A single call returns the state, balloon, vCPU and block statistics
+        of all domains instead of asking every one of them.  The snapshot is
+        kept until we change any of the domains, so the checks of the same
+        command can share it.  It is not used for the state of the domains,
+        as they can change on their own.
+        """
+        conn = self.conn()
+        if self._domain_stats is None or self._domain_stats_conn is not conn:
+            self._domain_stats = {
+                domain.name(): stats
+                for domain, stats in conn.getAllDomainStats(
+                    VIR_DOMAIN_STATS_STATE |
+                    VIR_DOMAIN_STATS_BALLOON |
+                    VIR_DOMAIN_STATS_VCPU |
+                    VIR_DOMAIN_STATS_BLOCK
+                )
+            }
+            self._domain_stats_conn = conn
+        return self._domain_stats
+
+    def _invalidate_domain_stats(self):
+        """Forget the statistics snapshot after changing any domain"""
+        self._domain_stats = None
+        self._domain_stats_conn = None
+
+    def get_vm_stats(self, vm):
+        """Return the statistics of the domain of a VM from the snapshot"""
+        name = self._get_domain(vm).name()
+        stats = self.get_domain_stats()
+        if name not in stats:
+            # The domain might be defined after the snapshot by somebody else
+            self._invalidate_domain_stats()
+            stats = self.get_domain_stats()
+        return stats.get(name, {})
+
     def vm_info(self, vm):
         """Get runtime information about a VM"""
         props = DomainProperties.from_running(self, vm, self._get_domain(vm))
@@ -735,12 +1184,19 @@ class Hypervisor(Host):
         vg_size_gib = math.floor(float(pool_info[3]) / 1024 ** 3)
         if safe is True:
             vg_size_gib -= RESERVED_DISK[self.get_storage_type()]
+        vg_size_gib -= sum(
+            v.dataset_obj['disk_size_gib'] for v in self.planned_vms
+        )
         return vg_size_gib
 
     def mount_temp(self, device, suffix=''):
         """Mounts given device into temporary path"""
-        mount_dir = self.run('mktemp -d --suffix {}'.format(suffix))
-        self.run('mount {0} {1}'.format(device, mount_dir))
+        # The commands of a batch share the shell and its variables
+        mount_dir = self.run_batch([
+            'mount_dir=$(mktemp -d --suffix {}) && echo $mount_dir'
+            .format(suffix),
+            'mount {} $mount_dir'.format(device),
+        ])[0]
         return mount_dir
 
     def umount_temp(self, device_or_path):
@@ -790,17 +1246,27 @@ class Hypervisor(Host):
         self.run('pkill -f "^/bin/nc.openbsd -l -p {}"'.format(port))
 
     @contextmanager
-    def netcat_to_device(self, device):
+    def netcat_to_device(
+        self, device, compress=False, sparse=False, writer=None,
+    ):
         dev_minor = self.run('stat -L -c "%T" {}'.format(device), silent=True)
         dev_minor = int(dev_minor, 16)
         port = 7000 + dev_minor
 
         self.check_netcat(port)
 
-        # Using DD lowers load on device with big enough Block Size
+        if writer is None:
+            # Using DD lowers load on device with big enough Block Size
+            writer = 'dd of={device} obs=1048576' + (
+                ' conv=sparse' if sparse else ''
+            )
         self.run(
-            'nohup /bin/nc.openbsd -l -p {0} | dd of={1} obs=1048576 &'
-            .format(port, device)
+            'nohup /bin/nc.openbsd -l -p {0} | {1}{2} &'
+            .format(
+                port,
+                NETCAT_DECOMPRESS + ' | ' if compress else '',
+                writer.format(device=device),
+            )
         )
         try:
             yield self.fqdn, port
@@ -808,10 +1274,380 @@ class Hypervisor(Host):
             self.kill_netcat(port)
             raise
 
-    def device_to_netcat(self, device, size, listener):
-        # Using DD lowers load on device with big enough Block Size
-        self.run(
-            'dd if={0} ibs=1048576 | pv -f -s {1} '
-            '| /bin/nc.openbsd -q 1 {2} {3}'
-            .format(device, size, *listener)
+    @traced('transport')
+    def device_to_netcat(self, device, size, listener, compress=False):
+        if not compress:
+            # Using DD lowers load on device with big enough Block Size
+            self.run(
+                'dd if={0} ibs=1048576 | pv -f -s {1} '
+                '| /bin/nc.openbsd -q 1 {2} {3}'
+                .format(device, size, *listener)
+            )
+            return
+
+        # The second pv counts the compressed bytes sent over the wire.
+        bytes_file = self.run('mktemp', silent=True)
+        start = time()
+        try:
+            self.run(
+                'dd if={0} ibs=1048576 | pv -f -s {1} | {2} '
+                '| pv -n -b 2> {3} | /bin/nc.openbsd -q 1 {4} {5}'
+                .format(
+                    device, size, NETCAT_COMPRESS, bytes_file, *listener
+                )
+            )
+            duration = time() - start
+            sent = self.run(
+                'tail -n 1 {}'.format(bytes_file), silent=True
+            ).strip()
+        finally:
+            self.run('rm -f {}'.format(bytes_file), silent=True)
+
+        log.info(
+            'Transferred {:.2f} GiB in {:.0f}s ({:.2f} MiB/s), '
+            'sent {:.2f} GiB compressed (ratio {:.2f})'.format(
+                size / 1024 ** 3,
+                duration,
+                size / 1024 ** 2 / max(duration, 1),
+                int(sent) / 1024 ** 3 if sent.isdigit() else 0,
+                size / int(sent) if sent.isdigit() and int(sent) else 0,
+            )
+        )
+
+    @traced('transport')
+    def copy_device_parallel(
+        self, device, target_hypervisor, target_device, size_mib,
+        streams=NETCAT_PARALLEL_STREAMS,
+    ):
+        """Copy a device to another hypervisor over parallel streams
+
+        The device is split into equal ranges of MiBs, every range is sent
+        over its own netcat stream and written at its offset on the target.
+        Both ends checksum the ranges while streaming them, so the devices
+        are not read again.  The checksums are compared at the end.
+        """
+        if not 0 < streams <= NETCAT_PARALLEL_MAX_STREAMS:
+            raise StorageError(
+                'Number of streams must be between 1 and {}'
+                .format(NETCAT_PARALLEL_MAX_STREAMS)
+            )
+        range_mib = int(math.ceil(float(size_mib) / streams))
+        ranges = [
+            (i * range_mib, min(range_mib, size_mib - i * range_mib))
+            for i in range(streams)
+            if i * range_mib < size_mib
+        ]
+
+        start = time()
+        with self.range_checksums_dir(len(ranges)) as source_dir, \
+                target_hypervisor.range_checksums_dir(len(ranges)) \
+                as target_dir:
+            with target_hypervisor.netcat_to_device_ranges(
+                target_device, ranges, target_dir
+            ) as listeners:
+                self.device_ranges_to_netcat(
+                    device, ranges, listeners, source_dir
+                )
+            retry_wait_backoff(
+                lambda: target_hypervisor.run(
+                    ' && '.join(
+                        'test -s {}/{}.rc'.format(target_dir, i)
+                        for i in range(len(ranges))
+                    ),
+                    warn_only=True,
+                    silent=True,
+                ).succeeded,
+                'Ranges are still being written',
+                max_wait=600,
+            )
+            duration = time() - start
+            return_codes = target_hypervisor.read_range_files(
+                target_dir, 'rc'
+            )
+            source_sums = self.read_range_files(source_dir, 'md5')
+            target_sums = target_hypervisor.read_range_files(
+                target_dir, 'md5'
+            )
+        log.info(
+            'Transferred {:.2f} GiB over {} streams in {:.0f}s ({:.2f} MiB/s)'
+            .format(
+                size_mib / 1024.0, len(ranges), duration,
+                size_mib / max(duration, 1),
+            )
         )
+
+        for i, (skip, count) in enumerate(ranges):
+            if return_codes.get(i) != '0':
+                raise StorageError(
+                    'Writing the range of {} MiB at {} MiB of "{}" failed '
+                    'with exit code {}'
+                    .format(count, skip, target_device, return_codes.get(i))
+                )
+            if source_sums.get(i) is None or target_sums.get(i) is None:
+                raise StorageError(
+                    'Checksum of range of {} MiB at {} MiB of "{}" is missing'
+                    .format(count, skip, target_device)
+                )
+            if source_sums[i] != target_sums[i]:
+                raise StorageError(
+                    'Checksum mismatch in range of {} MiB at {} MiB of "{}"'
+                    .format(count, skip, target_device)
+                )
+        log.info('Checksums of all {} ranges match'.format(len(ranges)))
+
+    def get_stale_volume(self, vm):
+        """Return a left over volume of the VM with matching size
+
+        Returns None, if there is no such volume.  The volumes of
+        a different size are left alone.
+        """
+        try:
+            volume = self.get_volume_by_vm(vm)
+        except StorageError:
+            return None
+
+        if volume.info()[1] != vm.dataset_obj['disk_size_gib'] * 1024 ** 3:
+            log.warning(
+                'Not reusing stale volume "{}" on "{}" of different size, '
+                'removing it and copying the whole disk instead'
+                .format(volume.name(), self.fqdn)
+            )
+            return None
+
+        log.info(
+            'Reusing stale volume "{}" on "{}"'
+            .format(volume.name(), self.fqdn)
+        )
+        return volume
+
+    @traced('transport')
+    def copy_device_diff(self, device, target_hypervisor, target_device):
+        """Copy only the differing blocks of a device to another hypervisor
+
+        Both hypervisors checksum the blocks of their devices, then only
+        the blocks with different checksums are streamed over netcat and
+        written at their offsets on the target.
+        """
+        with self.blockdiff() as source_dir, \
+                target_hypervisor.blockdiff() as target_dir:
+            source_hashes = self.device_block_hashes(device, source_dir)
+            target_hashes = target_hypervisor.device_block_hashes(
+                target_device, target_dir
+            )
+            if len(source_hashes) != len(target_hashes):
+                raise StorageError(
+                    'Devices "{}" and "{}" differ in size'
+                    .format(device, target_device)
+                )
+
+            indexes = [
+                i for i, (s, t) in enumerate(zip(source_hashes, target_hashes))
+                if s != t
+            ]
+            log.info(
+                '{} of {} blocks differ, sending {:.2f} GiB'.format(
+                    len(indexes), len(source_hashes),
+                    len(indexes) * NETCAT_DIFF_BLOCK_SIZE / 1024.0 ** 3,
+                )
+            )
+            if not indexes:
+                return
+
+            index_fd = BytesIO('\n'.join(str(i) for i in indexes).encode())
+            self.put(source_dir + '/index', index_fd)
+            target_hypervisor.put(
+                target_dir + '/index', BytesIO(index_fd.getvalue())
+            )
+
+            start = time()
+            with target_hypervisor.netcat_to_device(
+                target_device,
+                # The writer is in the background, it leaves its exit code
+                # behind for us to wait for.
+                writer=(
+                    '( {0}/blockdiff write {{device}} {1} {0}/index; '
+                    'echo $? > {0}/write.rc )'
+                    .format(target_dir, NETCAT_DIFF_BLOCK_SIZE)
+                ),
+            ) as listener:
+                self.run(
+                    '{0}/blockdiff read {1} {2} {0}/index '
+                    '| /bin/nc.openbsd -q 1 {3} {4}'.format(
+                        source_dir,
+                        device,
+                        NETCAT_DIFF_BLOCK_SIZE,
+                        *listener
+                    )
+                )
+                retry_wait_backoff(
+                    lambda: target_hypervisor.run(
+                        'test -s {}/write.rc'.format(target_dir),
+                        warn_only=True,
+                        silent=True,
+                    ).succeeded,
+                    'Blocks are still being written',
+                    max_wait=600,
+                )
+            return_code = target_hypervisor.run(
+                'cat {}/write.rc'.format(target_dir), silent=True
+            ).strip()
+            if return_code != '0':
+                raise StorageError(
+                    'Writing the blocks to "{}" failed with exit code {}'
+                    .format(target_device, return_code)
+                )
+        log.info('Sent differing blocks in {:.0f}s'.format(time() - start))
+
+    def device_block_hashes(self, device, blockdiff_dir):
+        """Return the list of checksums of the blocks of a device"""
+        return self.run(
+            '{}/blockdiff hashes {} {}'.format(
+                blockdiff_dir, device, NETCAT_DIFF_BLOCK_SIZE
+            ),
+            silent=True,
+        ).split()
+
+    @contextmanager
+    def blockdiff(self):
+        """Upload the blockdiff helper for the duration of the context
+
+        It is uploaded on every use into a new directory only accessible
+        by root, and its checksum is verified before it is run as root.
+        The directory is yielded, the other files of the transport are kept
+        in there as well.
+        """
+        with open(
+            path.join(path.dirname(__file__), 'scripts', 'blockdiff'), 'rb'
+        ) as fd:
+            script = fd.read()
+        remote_dir = self.run(
+            'mktemp -d /tmp/igvm_blockdiff.XXXXXX', silent=True
+        ).strip()
+        try:
+            self.put(remote_dir + '/blockdiff', BytesIO(script), '0700')
+            checksum = self.run(
+                'sha256sum {}/blockdiff'.format(remote_dir), silent=True
+            ).split()[0]
+            if checksum != sha256(script).hexdigest():
+                raise StorageError(
+                    'Checksum mismatch of the blockdiff helper on "{}"'
+                    .format(self.fqdn)
+                )
+            yield remote_dir
+        finally:
+            self.run('rm -rf {}'.format(remote_dir), silent=True)
+
+    def _netcat_parallel_ports(self, device, count):
+        """Return free ports on the hypervisor for the streams to the device
+
+        The search starts at a port derived from the device minor and wraps
+        around within the port range.
+        """
+        dev_minor = self.run('stat -L -c "%T" {}'.format(device), silent=True)
+        dev_minor = int(dev_minor, 16)
+        used = {
+            int(p) for p in (
+                a.rsplit(':', 1)[-1] for a in self.run(
+                    "ss -Htln | awk '{print $4}'", silent=True
+                ).split()
+            )
+            if p.isdigit()
+        }
+        num_ports = NETCAT_PARALLEL_PORT_MAX - NETCAT_PARALLEL_PORT_BASE + 1
+        first = dev_minor * NETCAT_PARALLEL_MAX_STREAMS
+        ports = []
+        for offset in range(num_ports):
+            port = NETCAT_PARALLEL_PORT_BASE + (first + offset) % num_ports
+            if port not in used:
+                ports.append(port)
+            if len(ports) == count:
+                return ports
+        raise StorageError(
+            'Not enough free ports between {} and {} for {} streams on "{}"'
+            .format(
+                NETCAT_PARALLEL_PORT_BASE, NETCAT_PARALLEL_PORT_MAX, count,
+                self.fqdn,
+            )
+        )
+
+    @contextmanager
+    def range_checksums_dir(self, count):
+        """Create a directory for checksumming the ranges while streaming
+
+        The directory has a FIFO for every range to tee the stream into.
+        The checksum and other files of the ranges are written into it as
+        well.  It is removed at the end of the context.
+        """
+        remote_dir = self.run(
+            'mktemp -d /tmp/igvm_ranges.XXXXXX', silent=True
+        ).strip()
+        try:
+            self.run('mkfifo {}'.format(' '.join(
+                '{}/{}.fifo'.format(remote_dir, i) for i in range(count)
+            )), silent=True)
+            yield remote_dir
+        finally:
+            self.run('rm -rf {}'.format(remote_dir), silent=True)
+
+    def read_range_files(self, remote_dir, suffix):
+        """Return the first word of the files of the ranges by their index"""
+        output = self.run(
+            'cd {} && for f in *.{}; do echo ${{f%%.*}} $(cat $f); done'
+            .format(remote_dir, suffix),
+            silent=True,
+        )
+        values = {}
+        for line in output.splitlines():
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].isdigit():
+                values[int(parts[0])] = parts[1]
+        return values
+
+    @contextmanager
+    def netcat_to_device_ranges(self, device, ranges, checksums_dir):
+        # The writers are in the background, they leave the checksums and
+        # their exit codes behind for us to wait for.
+        ports = self._netcat_parallel_ports(device, len(ranges))
+
+        started = []
+        try:
+            for i, (port, (skip, count)) in enumerate(zip(ports, ranges)):
+                self.run(
+                    "nohup sh -c '"
+                    'md5sum < {0}/{1}.fifo > {0}/{1}.md5 & '
+                    '/bin/nc.openbsd -l -p {2} | tee {0}/{1}.fifo '
+                    '| dd of={3} bs=1048576 iflag=fullblock seek={4} '
+                    'conv=notrunc; '
+                    "rc=$?; wait; echo $rc > {0}/{1}.rc' "
+                    '> /dev/null 2>&1 &'
+                    .format(checksums_dir, i, port, device, skip)
+                )
+                started.append(port)
+            yield [(self.fqdn, p) for p in ports]
+        except BaseException:
+            for port in started:
+                self.kill_netcat(port)
+            raise
+
+    def device_ranges_to_netcat(
+        self, device, ranges, listeners, checksums_dir
+    ):
+        # All streams are started in the background of a single shell, and
+        # we wait for each of them to report the failures.  They wait for
+        # their checksums to be written.
+        commands = []
+        for i, ((skip, count), (host, port)) in enumerate(
+            zip(ranges, listeners)
+        ):
+            commands.append(
+                '( md5sum < {0}/{1}.fifo > {0}/{1}.md5 & '
+                'dd if={2} bs=1048576 skip={3} count={4} '
+                '| tee {0}/{1}.fifo | /bin/nc.openbsd -q 1 {5} {6}; '
+                'rc=$?; wait; exit $rc ) & p{1}=$!'
+                .format(checksums_dir, i, device, skip, count, host, port)
+            )
+        commands.append('fail=0')
+        for i in range(len(ranges)):
+            commands.append('wait $p{} || fail=1'.format(i))
+        commands.append('exit $fail')
+        self.run(' ; '.join(commands))
@@ -41,10 +41,7 @@ class InsufficientResource(object):
             return False
 
         total_size = hv.dataset_obj[self.hv_attribute]
-        vms_size = sum(
-            vm[self.vm_attribute] * self.multiplier
-            for vm in hv.dataset_obj['vms']
-        )
+        vms_size = hv.vms_total(self.vm_attribute) * self.multiplier
         remaining_size = total_size - vms_size - self.reserved
 
         return remaining_size < vm.dataset_obj[self.vm_attribute]
@@ -67,20 +64,19 @@ class OtherVMs(object):
         return '{}({})'.format(type(self).__name__, args)
 
     def __call__(self, vm, hv):
-        result = 0
-        for other_vm in hv.dataset_obj['vms']:
-            if other_vm['hostname'] == vm.dataset_obj['hostname']:
-                continue
-            if self.values and not all(
-                vm.dataset_obj[a] == v
-                for a, v in zip(self.attributes, self.values)
-            ):
-                continue
-            if all(
-                other_vm[a] == vm.dataset_obj[a]
-                for a in self.attributes
-            ):
-                result += 1
+        if self.values and not all(
+            vm.dataset_obj[a] == v
+            for a, v in zip(self.attributes, self.values)
+        ):
+            return 0
+
+        key = tuple(vm.dataset_obj[a] for a in self.attributes)
+        result = hv.vms_counter(self.attributes)[key]
+
+        # The VM itself doesn't count, if it is already on the hypervisor.
+        result -= hv.vms_counter(['hostname'] + list(self.attributes))[
+            (vm.dataset_obj['hostname'], ) + key
+        ]
 
         return result
 
@@ -145,14 +141,12 @@ class OverAllocation(object):
         if not vm.hypervisor:
             return False
 
-        cur_hv_cpus = sum(
-            v[self.attribute] for v in vm.hypervisor.dataset_obj['vms']
-        )
+        cur_hv_cpus = vm.hypervisor.vms_total(self.attribute)
         cur_hv_rl_cpus = vm.hypervisor.dataset_obj[self.attribute]
         cur_ovr_allc = float(cur_hv_cpus) / float(cur_hv_rl_cpus)
 
-        tgt_hv_cpus = vm.dataset_obj[self.attribute] + sum(
-            v[self.attribute] for v in hv.dataset_obj['vms']
+        tgt_hv_cpus = vm.dataset_obj[self.attribute] + hv.vms_total(
+            self.attribute
         )
         tgt_hv_rl_cpus = hv.dataset_obj[self.attribute]
         tgt_ovr_allc = float(tgt_hv_cpus) / float(tgt_hv_rl_cpus)
@@ -0,0 +1,287 @@
+"""igvm - Hypervisor Image Cache
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+# The images are cached on the hypervisors content-addressed by their SHA-256
+# under IMAGE_CACHE_PATH:
+#
+#   sha256/<digest>     the image tarballs
+#   names/<image>       symlink to the tarball of the image
+#   names/<image>.md5   checksum published for it on the image server
+#   locks/<image>.lock  held while the image is checked and downloaded
+#   tmp/                the downloads in progress
+#
+# Only the small checksum file is downloaded, when the published checksum
+# didn't change.  The tarballs are locked shared while they are extracted,
+# and the least recently used ones which are not locked are evicted when the
+# cache grows above IMAGE_CACHE_SIZE_GIB.
+#
+# The images missing from the cache are streamed from the image server
+# through the decompressor into tar while their checksums are calculated, so
+# the extraction doesn't wait for the download.  The stream is only written
+# into the cache, if the cache is enabled.
+
+from logging import getLogger
+import re
+
+from igvm.exceptions import ConfigError
+from igvm.settings import (
+    IGVM_IMAGE_MD5_URL,
+    IGVM_IMAGE_URL,
+    IMAGE_CACHE_EXTRACT_LOCK_TIMEOUT,
+    IMAGE_CACHE_LOCK_TIMEOUT,
+    IMAGE_CACHE_PATH,
+    IMAGE_CACHE_SIZE_GIB,
+)
+
+log = getLogger(__name__)
+
+
+class ImageCache(object):
+    def __init__(self, host):
+        self.host = host
+
+    def prefetch(self, image):
+        """Make sure the latest version of the image is in the cache
+
+        Returns the SHA-256 digest of the image.
+        """
+        image = _check_name(image)
+        return self._log_result(image, self.host.run('\n'.join(
+            self._check_script(image) +
+            [
+                'if [ -z "$hit" ]; then',
+                '    start=$(date +%s%N)',
+                '    curl -sSf -o "$tmp" {}'
+                .format(IGVM_IMAGE_URL.format(image=image)),
+                '    echo "download $((($(date +%s%N) - start) / 1000000))"',
+                '    md5sum "$tmp" > "$tmp.md5"',
+                '    sha256sum "$tmp" > "$tmp.sha256"',
+            ] +
+            self._store_script(image) +
+            [
+                'fi',
+            ] +
+            self._evict_script()
+        ), silent=True))
+
+    def extract(self, image, target_dir):
+        """Extract the image from the cache or stream it from the server
+
+        The lock of the image is given up as soon as the tarball is locked,
+        so the concurrent builds are only serialized while it is downloaded.
+        The download is streamed into tar, so the lock is held until the
+        extraction finishes.  The concurrent builds don't wait for that, but
+        stream the image themselves without writing it into the cache.
+        Returns the SHA-256 digest of the image.
+        """
+        image = _check_name(image)
+        tar = 'tar --xattrs --xattrs-include=\'*\' -x -C {}'.format(target_dir)
+        decompress = _get_decompress_command(image)
+        return self._log_result(image, self.host.run('\n'.join(
+            self._check_script(image, IMAGE_CACHE_EXTRACT_LOCK_TIMEOUT) +
+            [
+                # The remote shell has no pipefail, so the commands in the
+                # pipes record their exit codes.
+                'stage() { rc=0; "$@" || rc=$?; echo "$1 $rc" >> "$tmp.rc"; }',
+                'start=$(date +%s%N)',
+                'if [ -n "$hit" ]; then',
+                '    exec 8<"names/{}"'.format(image),
+                '    flock -s 8',
+                '    flock -u 9',
+                '    stage {} < "names/{}" | stage {}'
+                .format(decompress, image, tar),
+                'else',
+                '    mkfifo "$tmp.md5.fifo" "$tmp.sha256.fifo"',
+                '    md5sum < "$tmp.md5.fifo" > "$tmp.md5" &',
+                '    md5_pid=$!',
+                '    sha256sum < "$tmp.sha256.fifo" > "$tmp.sha256" &',
+                '    sha256_pid=$!',
+                '    cache={}'.format(
+                    '"$tmp"' if IMAGE_CACHE_SIZE_GIB > 0 else ''
+                ),
+                '    [ -n "$locked" ] || cache=',
+                '    {{ stage curl -sSf {}; date +%s%N > "$tmp.end"; }} |'
+                .format(IGVM_IMAGE_URL.format(image=image)),
+                '        stage tee "$tmp.md5.fifo" "$tmp.sha256.fifo" $cache '
+                '|',
+                '        stage {} | stage {}'.format(decompress, tar),
+                # They exit as soon as tee closes the pipes.
+                '    wait $md5_pid && wait $sha256_pid || '
+                '{{ echo "Checksumming {} failed" >&2; exit 1; }}'
+                .format(image),
+                '    end=$(cat "$tmp.end")',
+                '    echo "download $(((end - start) / 1000000))"',
+                'fi',
+                'if grep -v " 0$" "$tmp.rc" >&2; then',
+                '    echo "Extracting {} failed" >&2'.format(image),
+                '    exit 1',
+                'fi',
+                'if [ -z "$hit" ]; then',
+            ] +
+            self._store_script(image) +
+            [
+                'fi',
+                'echo "extract $((($(date +%s%N) - start) / 1000000))"',
+            ] +
+            self._evict_script()
+        ), silent=True))
+
+    def get_published_md5(self, image):
+        """Return the checksum published for the image on the image server
+
+        Returns None, if the image server is down.
+        """
+        image = _check_name(image)
+        result = self.host.run(
+            'curl -sSf {}'.format(IGVM_IMAGE_MD5_URL.format(image=image)),
+            warn_only=True,
+            silent=True,
+        )
+        if not result.succeeded or not result.strip():
+            return None
+        return result.split()[0]
+
+    def _check_script(self, image, fallback_timeout=None):
+        """Lock the image and check whether the cached one is the latest
+
+        $hit is set to the digest of the cached image or left empty.  $tmp
+        is set to a temporary file for the download.  With the fallback
+        timeout, we go on without the lock after waiting that long for it,
+        and $locked is left empty.  The downloads must not be stored then.
+        The scripts are run by /bin/sh, so they must stick to POSIX.
+        """
+        if fallback_timeout is None:
+            wait = [
+                '    echo "Waiting up to {}s for {} being downloaded by '
+                'another igvm"'.format(IMAGE_CACHE_LOCK_TIMEOUT, image),
+                '    flock -w {} 9 || {{ echo "Timed out waiting for the lock '
+                'of {}" >&2; exit 1; }}'
+                .format(IMAGE_CACHE_LOCK_TIMEOUT, image),
+            ]
+        else:
+            wait = [
+                '    echo "Waiting up to {}s for {} being downloaded by '
+                'another igvm"'.format(fallback_timeout, image),
+                '    flock -w {} 9 || {{ locked=; echo "Streaming {} without '
+                'the cache"; }}'.format(fallback_timeout, image),
+            ]
+        return [
+            'set -e',
+            'mkdir -p {}'.format(IMAGE_CACHE_PATH),
+            'cd {}'.format(IMAGE_CACHE_PATH),
+            'mkdir -p sha256 names locks tmp',
+            'exec 9>"locks/{}.lock"'.format(image),
+            'locked=1',
+            # The output is shown while the command is running.
+            'if ! flock -n 9; then',
+        ] + wait + [
+            'fi',
+            'tmp=$(mktemp "tmp/{}.XXXXXX")'.format(image),
+            'trap \'rm -f "$tmp" "$tmp".*\' EXIT',
+            'md5=$(curl -sSf {}) && md5=${{md5%% *}} || md5='
+            .format(IGVM_IMAGE_MD5_URL.format(image=image)),
+            # Keep using the cached image, if the image server is down
+            'if [ -e "names/{0}" ] && {{ [ -z "$md5" ] || '
+            '[ "$md5" = "$(cat "names/{0}.md5")" ]; }}; then'
+            .format(image),
+            '    hit=$(basename "$(readlink "names/{}")")'.format(image),
+            '    touch -c "sha256/$hit"',
+            '    echo "hit $hit"',
+            'else',
+            '    hit=',
+            '    [ -n "$md5" ] || {{ echo "No checksum for {}" >&2; exit 1; }}'
+            .format(image),
+            'fi',
+        ]
+
+    def _store_script(self, image):
+        """Verify the download and store it, if it was written to $tmp"""
+        return [
+            '    sum=$(cat "$tmp.md5") && sum=${sum%% *}',
+            '    [ "$sum" = "$md5" ] || '
+            '{{ echo "Checksum mismatch of {}" >&2; exit 1; }}'.format(image),
+            '    sha=$(cat "$tmp.sha256") && sha=${sha%% *}',
+            '    if [ -s "$tmp" ]; then',
+            '        if [ -e "sha256/$sha" ]; then',
+            '            touch "sha256/$sha"',
+            '        else',
+            '            chmod 644 "$tmp"',
+            '            mv "$tmp" "sha256/$sha"',
+            '        fi',
+            '        ln -sfn "../sha256/$sha" "names/{}.new"'.format(image),
+            '        mv -T "names/{0}.new" "names/{0}"'.format(image),
+            '        echo "$md5" > "names/{}.md5"'.format(image),
+            '    fi',
+            '    echo "miss $sha"',
+        ]
+
+    def _evict_script(self):
+        """Evict the least recently used images above the budget
+
+        The other igvm processes might be evicting the same images, so
+        the failures are only reported.  The commands of a group on the left
+        side of || are not subject to set -e.
+        """
+        return [
+            '{',
+            '    total=$(du -sb sha256 2>/dev/null) || true',
+            '    total=${total%%[[:space:]]*}',
+            '    for sha in $(ls -tr sha256); do',
+            '        [ "$total" -gt {} ] 2>/dev/null || break'
+            .format(IMAGE_CACHE_SIZE_GIB * 1024 ** 3),
+            '        size=$(stat -c %s "sha256/$sha" 2>/dev/null) || continue',
+            # The ones being extracted are locked
+            '        if flock -n "sha256/$sha" rm -f "sha256/$sha"; then',
+            '            total=$((total - size))',
+            '            echo "evicted $sha"',
+            '        fi',
+            '    done',
+            '    find names -xtype l -delete',
+            '    find tmp -type f -mmin +1440 -delete',
+            '} || echo "Evicting images failed" >&2',
+        ]
+
+    def _log_result(self, image, output):
+        digest = None
+        for line in output.splitlines():
+            words = line.split()
+            if len(words) != 2:
+                continue
+            if words[0] == 'hit':
+                digest = words[1]
+                log.info('Image "{}" is cached on "{}" as {}'.format(
+                    image, self.host, words[1]
+                ))
+            elif words[0] == 'miss':
+                digest = words[1]
+                log.info('Image "{}" is downloaded to "{}" as {}'.format(
+                    image, self.host, words[1]
+                ))
+            elif words[0] == 'evicted':
+                log.info('Image {} is evicted from "{}"'.format(
+                    words[1], self.host
+                ))
+            elif words[0] in ('download', 'extract'):
+                log.info('{} of image "{}" on "{}" took {:.1f}s'.format(
+                    words[0].capitalize(), image, self.host,
+                    int(words[1]) / 1000.0,
+                ))
+        return digest
+
+
+def _check_name(image):
+    # The name ends up in the paths and shell commands
+    if not re.match(r'^[a-zA-Z0-9][a-zA-Z0-9._\-]*$', image):
+        raise ConfigError('Invalid image name "{}"'.format(image))
+    return image
+
+
+def _get_decompress_command(image):
+    """Return the command to decompress the image using all cores"""
+    if image.endswith('.zst'):
+        return 'zstd -dc -T0'
+    # pigz can only use a single thread for decompressing, but it still
+    # outperforms gzip by doing the reading, writing and checksumming in
+    # separate threads.
+    return '"$(command -v pigz || echo gzip)" -dc'
@@ -34,6 +34,7 @@ from igvm.settings import (
     VG_NAME,
     MIGRATE_CONFIG,
 )
+from igvm.tracing import traced
 from igvm.utils import parse_size
 
 from jinja2 import Environment, PackageLoader
@@ -123,7 +124,9 @@ class DomainProperties(object):
         self.uuid = domain.UUIDString()
         self.hugepages = tree.find('memoryBacking/hugepages') is not None
         self.num_nodes = max(len(tree.findall('cpu/numa/cell')), 1)
-        self.max_cpus = domain.vcpusFlags(VIR_DOMAIN_VCPU_MAXIMUM)
+        self.max_cpus = hypervisor.get_vm_stats(vm).get(
+            'vcpu.maximum'
+        ) or domain.vcpusFlags(VIR_DOMAIN_VCPU_MAXIMUM)
         self.mem_hotplug = tree.find('maxMemory') is not None
 
         memballoon = tree.find('devices/memballoon')
@@ -231,6 +234,7 @@ def migrate_background(
         raise MigrationError(e)
 
 
+@traced('transport')
 def migrate_live(source, destination, vm, domain):
     """Live-migrates a VM via libvirt."""
 
@@ -307,6 +311,7 @@ def migrate_live(source, destination, vm, domain):
         log.info('Migration finished')
 
         # And pin again, in case we migrated to a host with more physical cores
+        destination._invalidate_domain_index()
         domain = destination._get_domain(vm)
         _live_repin_cpus(domain, props, destination.dataset_obj['num_cpu'])
 
@@ -420,13 +425,7 @@ def generate_domain_xml(hypervisor, vm):
 
 
 def _get_qemu_version(hypervisor):
-    version = hypervisor.conn().getVersion()
-    # According to documentation:
-    # value is major * 1,000,000 + minor * 1,000 + release
-    release = version % 1000
-    minor = int(version / 1000 % 1000)
-    major = int(version / 1000000 % 1000000)
-    return major, minor, release
+    return tuple(hypervisor.get_facts()['qemu_version'])
 
 
 def _set_cpu_model(hypervisor, vm, tree):
@@ -471,10 +470,7 @@ def _place_numa(hypervisor, vm, tree, props):
     num_vcpus = props.max_cpus
 
     # Which physical CPU belongs to which physical node
-    pcpu_sets = hypervisor.run(
-        'cat /sys/devices/system/node/node*/cpulist',
-        silent=True,
-    ).splitlines()
+    pcpu_sets = hypervisor.get_facts()['numa_cpulists']
     num_nodes = len(pcpu_sets)
     assert num_nodes == len(pcpu_sets)
     nodeset = ','.join(str(i) for i in range(0, num_nodes))
@@ -3,15 +3,108 @@
 Copyright (c) 2018 InnoGames GmbH
 """
 
-from libvirt import open as libvirt_open, libvirtError
-from os import path, environ
+from collections import Counter
+from logging import getLogger
+from os import environ, getpid
+from threading import Lock, Thread
 
+from libvirt import (
+    VIR_CONNECT_CLOSE_REASON_CLIENT,
+    VIR_ERR_SYSTEM_ERROR,
+    libvirtError,
+    open as libvirt_open,
+    virConnect,
+    virDomain,
+    virEventRegisterDefaultImpl,
+    virEventRunDefaultImpl,
+    virStoragePool,
+    virStorageVol,
+)
+
+from igvm.settings import LIBVIRT_KEEPALIVE_COUNT, LIBVIRT_KEEPALIVE_INTERVAL
+from igvm.sshpool import get_ssh_command
+from igvm.tracing import span
 from igvm.utils import get_ssh_config
 
+log = getLogger(__name__)
+
 _conns = {}
+_inherited_conns = []
+_host_locks = {}
+_lock = Lock()
+_event_loop_pid = None
+_conns_pid = getpid()
+
+# Number of connections opened, reused from the cache and opened again
+# after the cached one was found dead
+metrics = Counter()
+
+
+def _start_event_loop():
+    """Start the libvirt event loop needed for keepalive and close callbacks
+
+    It is started once and only by the process which registered it.  Our
+    scheduler workers are not forked, but a forked child would inherit
+    the loop still watching the sockets of the parent, so we must not run
+    it there.  The child forgets the cached connections of the parent
+    without closing them, because that would close the ones of the parent
+    as well.  We keep referencing them, so that they are not closed on
+    garbage collection either.  The connections of the child go without
+    keepalive, if the loop was started by the parent.
+    """
+    global _event_loop_pid
+
+    _forget_inherited_conns()
+    if _event_loop_pid is None:
+        virEventRegisterDefaultImpl()
+
+        def run():
+            while True:
+                virEventRunDefaultImpl()
+
+        Thread(target=run, name='libvirt-event-loop', daemon=True).start()
+        _event_loop_pid = getpid()
+
+
+def _forget_inherited_conns():
+    global _conns_pid
+
+    if _conns_pid == getpid():
+        return
+    _inherited_conns.extend(_conns.values())
+    _conns.clear()
+    _host_locks.clear()
+    _conns_pid = getpid()
+
+
+def _get_host_lock(fqdn):
+    with _lock:
+        _start_event_loop()
+        if fqdn not in _host_locks:
+            _host_locks[fqdn] = Lock()
+        return _host_locks[fqdn]
 
 
 def get_virtconn(fqdn):
+    with _get_host_lock(fqdn):
+        conn = _conns.get(fqdn)
+        if conn is not None:
+            if _is_alive(conn):
+                metrics['reused'] += 1
+                return conn
+            log.warning(
+                'libvirt connection to "{}" is dead, reconnecting'.format(fqdn)
+            )
+            metrics['reconnected'] += 1
+            _close(conn)
+        else:
+            metrics['opened'] += 1
+
+        _conns[fqdn] = _open(fqdn)
+        return _conns[fqdn]
+
+
+def _open(fqdn):
     if 'IGVM_SSH_USER' in environ:
         username = environ.get('IGVM_SSH_USER') + '@'
     else:
@@ -21,25 +114,109 @@ def get_virtconn(fqdn):
         else:
             username = ''
 
-    scripts_dir = path.join(path.dirname(__file__), 'scripts')
-
-    if fqdn not in _conns:
-        url = (
-            'qemu+ssh://{}{}/system?'
-            'socket=/var/run/libvirt/libvirt-sock&'
-            'command={}/ssh_wrapper'
-        ).format(
-            username, fqdn, scripts_dir
+    url = (
+        'qemu+ssh://{}{}/system?'
+        'socket=/var/run/libvirt/libvirt-sock&'
+        'command={}'
+    ).format(
+        username, fqdn, get_ssh_command()
+    )
+    with span('libvirt', 'open', host=fqdn):
+        conn = libvirt_open(url)
+    if _event_loop_pid == getpid():
+        conn.setKeepAlive(
+            LIBVIRT_KEEPALIVE_INTERVAL, LIBVIRT_KEEPALIVE_COUNT
         )
-        _conns[fqdn] = libvirt_open(url)
-    return _conns[fqdn]
+        conn.registerCloseCallback(_on_close, fqdn)
+    return _Traced(conn, fqdn)
+
+
+def _on_close(conn, reason, fqdn):
+    """Forget the connection closed by the other end or the keepalive"""
+    if reason == VIR_CONNECT_CLOSE_REASON_CLIENT:
+        return
+    log.warning(
+        'libvirt connection to "{}" was closed with reason {}'
+        .format(fqdn, reason)
+    )
+    with _lock:
+        if _unwrap(_conns.get(fqdn)) is conn:
+            del _conns[fqdn]
+
+
+def _is_alive(conn):
+    try:
+        return conn.isAlive() == 1
+    except libvirtError as error:
+        if error.get_error_code() == VIR_ERR_SYSTEM_ERROR:
+            return False
+        raise
+
+
+def _close(conn):
+    try:
+        conn.unregisterCloseCallback()
+    except libvirtError:
+        pass
+    try:
+        conn.close()
+    except libvirtError:
+        pass
+
+
+class _Traced(object):
+    """Proxy of the libvirt objects recording a span for every call
+
+    Almost every call is a round-trip to the hypervisor.  The libvirt
+    objects returned by the calls are wrapped as well.
+    """
+    def __init__(self, obj, fqdn):
+        self._obj = obj
+        self._fqdn = fqdn
+
+    def __getattr__(self, name):
+        value = getattr(self._obj, name)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            args = [_unwrap(a) for a in args]
+            with span('libvirt', name, host=self._fqdn):
+                return _wrap(value(*args, **kwargs), self._fqdn)
+        return call
+
+    def __repr__(self):
+        return '<Traced:{!r}>'.format(self._obj)
+
+
+def _wrap(value, fqdn):
+    if isinstance(
+        value, (virConnect, virDomain, virStoragePool, virStorageVol)
+    ):
+        return _Traced(value, fqdn)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_wrap(v, fqdn) for v in value)
+    return value
+
+
+def _unwrap(value):
+    return value._obj if isinstance(value, _Traced) else value
 
 
 def close_virtconns():
-    for fqdn in list(_conns.keys()):
-        conn = _conns[fqdn]
-        try:
-            conn.close()
-        except libvirtError:
-            pass
-        del _conns[fqdn]
+    with _lock:
+        # Don't close the connections inherited from the parent process
+        _forget_inherited_conns()
+        fqdns = list(_conns.keys())
+    for fqdn in fqdns:
+        with _get_host_lock(fqdn):
+            conn = _conns.pop(fqdn, None)
+            if conn is not None:
+                _close(conn)
+    if any(metrics.values()):
+        log.debug(
+            'libvirt connections opened: {}, reused: {}, reconnected: {}'
+            .format(
+                metrics['opened'], metrics['reused'], metrics['reconnected']
+            )
+        )
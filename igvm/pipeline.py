@@ -0,0 +1,143 @@
+"""igvm - Pipeline of Dependent Stages
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+# Fabric is not thread-safe, so the stages running commands over it are run
+# one at a time in the calling thread.  The local stages, like the ones only
+# talking to libvirt or waiting for a scheduler job, run in threads
+# concurrently with them.  The remote stages are the ones registering
+# rollback actions, so the transactions keep seeing them in the order they
+# were done.
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from logging import getLogger
+from time import time
+
+from igvm.tracing import span
+
+log = getLogger(__name__)
+
+
+class Stage(object):
+    def __init__(self, name, fn, requires=(), remote=True):
+        self.name = name
+        self.fn = fn
+        self.requires = tuple(requires)
+        self.remote = remote
+        self.started_at = None
+        self.duration = None
+
+    def __repr__(self):
+        return '<Stage:{}>'.format(self.name)
+
+
+class Pipeline(object):
+    """Run the stages as soon as the stages they require are done
+
+    The results of the required stages are passed to the functions of the
+    stages as positional arguments in the given order.  When a stage fails,
+    no more stages are started, the running ones are waited for and the
+    error is raised.
+    """
+    def __init__(self, name, max_threads=4):
+        self.name = name
+        self.max_threads = max_threads
+        self.stages = []
+        self.results = {}
+
+    def add(self, name, fn, requires=(), remote=True):
+        for required in requires:
+            if not any(s.name == required for s in self.stages):
+                raise ValueError(
+                    'Stage "{}" requires unknown stage "{}"'
+                    .format(name, required)
+                )
+        self.stages.append(Stage(name, fn, requires, remote))
+
+    def run(self):
+        """Run all stages and return their results by name"""
+        pending = list(self.stages)
+        running = {}
+        errors = []
+        start = time()
+
+        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            while pending or running:
+                ready = [] if errors else [
+                    s for s in pending
+                    if all(r in self.results for r in s.requires)
+                ]
+                for stage in ready:
+                    if not stage.remote:
+                        pending.remove(stage)
+                        future = executor.submit(self._run_stage, stage, start)
+                        running[future] = stage
+
+                remote_stage = next((s for s in ready if s.remote), None)
+                if remote_stage:
+                    pending.remove(remote_stage)
+                    self._run_remote_stage(remote_stage, start, errors)
+                elif not self._wait(running, errors, pending):
+                    break
+                self._collect(running, errors)
+
+        self._log_timings(time() - start)
+        if errors:
+            raise errors[0]
+        return self.results
+
+    def _run_remote_stage(self, stage, start, errors):
+        try:
+            self._run_stage(stage, start)
+        except BaseException as exception:
+            errors.append(exception)
+
+    def _wait(self, running, errors, pending):
+        """Wait for a local stage to finish
+
+        Returns False when there is nothing to wait for anymore.
+        """
+        if running:
+            wait(running, return_when=FIRST_COMPLETED)
+            return True
+        if errors:
+            return False
+        raise ValueError('Stages {} can never be run'.format(pending))
+
+    def _collect(self, running, errors):
+        """Forget the local stages which are done and keep their errors"""
+        for future in [f for f in running if f.done()]:
+            del running[future]
+            exception = future.exception()
+            if exception is not None:
+                errors.append(exception)
+
+    def _run_stage(self, stage, start):
+        log.debug('Starting stage "{}" of {}'.format(stage.name, self.name))
+        stage.started_at = time() - start
+        try:
+            with span('stage', stage.name, remote=stage.remote):
+                result = stage.fn(*(self.results[r] for r in stage.requires))
+        finally:
+            stage.duration = time() - start - stage.started_at
+        self.results[stage.name] = result
+        log.info('Stage "{}" of {} took {:.1f}s'.format(
+            stage.name, self.name, stage.duration
+        ))
+        return result
+
+    def _log_timings(self, total):
+        stages = [s for s in self.stages if s.duration is not None]
+        if not stages:
+            return
+        log.info('Stages of {} took {:.1f}s, {:.1f}s saved by overlapping:'
+                 .format(self.name, total,
+                         max(sum(s.duration for s in stages) - total, 0)))
+        width = max(len(s.name) for s in stages)
+        for stage in sorted(stages, key=lambda s: s.started_at):
+            log.info('    {} +{:6.1f}s {:6.1f}s{}'.format(
+                stage.name.ljust(width),
+                stage.started_at,
+                stage.duration,
+                '' if stage.name in self.results else ' failed',
+            ))
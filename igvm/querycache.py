@@ -0,0 +1,123 @@
+"""igvm - Serveradmin Query Cache
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+# adminapi doesn't offer a way to cache the query results, so we are wrapping
+# the function it uses to send the requests.  The raw responses are cached,
+# and the objects are built from them anew every time, so changes on them
+# can never leak into the later queries.  The cache is only used inside the
+# query_cache() context meant for the read-only commands, but all commits
+# invalidate it.
+
+from contextlib import contextmanager
+from hashlib import sha1
+import json
+from logging import getLogger
+from os import listdir, makedirs, path, remove
+from time import time
+
+import adminapi.dataset
+
+from igvm.settings import QUERY_CACHE_DIR, QUERY_CACHE_TTL
+from igvm.tracing import span
+
+log = getLogger(__name__)
+
+_send_request = adminapi.dataset.send_request
+_responses = {}
+_enabled = False
+
+
+@contextmanager
+def query_cache():
+    """Serve the repeated Serveradmin queries from the cache"""
+    global _enabled
+
+    previous = _enabled
+    _enabled = True
+    try:
+        yield
+    finally:
+        _enabled = previous
+
+
+def invalidate_query_cache():
+    _responses.clear()
+    cache_dir = _get_cache_dir()
+    if cache_dir:
+        for file_name in listdir(cache_dir):
+            try:
+                remove(path.join(cache_dir, file_name))
+            except OSError:
+                # Another igvm might have removed it already
+                pass
+
+
+def send_request(endpoint, *args, **kwargs):
+    with span('serveradmin', endpoint.rsplit('/', 1)[-1]) as attributes:
+        if not endpoint.endswith('/query'):
+            # Anything else might be changing the objects
+            invalidate_query_cache()
+            return _send_request(endpoint, *args, **kwargs)
+        if not _enabled:
+            return _send_request(endpoint, *args, **kwargs)
+
+        key = sha1(json.dumps(
+            [endpoint, args, kwargs], default=repr, sort_keys=True
+        ).encode()).hexdigest()
+        response = _get_response(key)
+        attributes['cached'] = response is not None
+        if response is None:
+            response = _send_request(endpoint, *args, **kwargs)
+            _set_response(key, response)
+        else:
+            log.debug('Serving query {} from the cache'.format(key))
+        return response
+
+
+def _get_cache_dir():
+    if not QUERY_CACHE_DIR:
+        return None
+    cache_dir = path.expanduser(QUERY_CACHE_DIR)
+    makedirs(cache_dir, mode=0o700, exist_ok=True)
+    return cache_dir
+
+
+def _get_response(key):
+    if key in _responses:
+        stored_at, response = _responses[key]
+        if time() - stored_at <= QUERY_CACHE_TTL:
+            return json.loads(response)
+        del _responses[key]
+
+    cache_dir = _get_cache_dir()
+    if cache_dir:
+        cache_file = path.join(cache_dir, key)
+        try:
+            if time() - path.getmtime(cache_file) <= QUERY_CACHE_TTL:
+                with open(cache_file) as fd:
+                    return json.load(fd)
+        except (OSError, ValueError):
+            pass
+
+    return None
+
+
+def _set_response(key, response):
+    try:
+        serialized = json.dumps(response)
+    except TypeError as error:
+        log.debug('Cannot cache query {}: {}'.format(key, error))
+        return
+    _responses[key] = (time(), serialized)
+
+    cache_dir = _get_cache_dir()
+    if cache_dir:
+        try:
+            with open(path.join(cache_dir, key), 'w') as fd:
+                fd.write(serialized)
+        except OSError as error:
+            log.debug('Cannot store query {}: {}'.format(key, error))
+
+
+adminapi.dataset.send_request = send_request
@@ -0,0 +1,217 @@
+"""igvm - Bounded Job Scheduler
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+# Fabric keeps its connection and settings state in module globals, so
+# running several igvm operations from threads of the same process would
+# make them step on each other.  We are running every job in its own worker
+# process instead, the same way Fabric runs its parallel tasks.
+#
+# The worker processes are not forked from us, but from a fork server
+# started as a fresh interpreter.  A forked child would inherit the libvirt
+# event loop of the parent with its sockets and keepalive timers, and the
+# locks of the threads of the parent.  They don't inherit our logging
+# configuration and the Fabric settings either, so we are setting them up
+# in the workers.
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from logging import Logger, StreamHandler, getLogger
+from multiprocessing import get_context
+from sys import stderr
+from time import time
+
+import fabric.api
+from fabric.network import disconnect_all
+
+from igvm.libvirt import close_virtconns
+from igvm.settings import COMMON_FABRIC_SETTINGS
+from igvm.tracing import collect_trace, merge_trace, reset_trace, span
+
+log = getLogger(__name__)
+
+
+class Job(object):
+    """A single unit of work for the scheduler
+
+    The slots are (kind, name) tuples like ('hypervisor', 'hv01.example.com').
+    The scheduler would not start the job while any of its slots are
+    used by the maximum number of jobs allowed for that kind.
+    """
+    def __init__(self, name, fn, args=(), kwargs=None, slots=()):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.slots = tuple(s for s in slots if s[1] is not None)
+
+    def __repr__(self):
+        return '<Job:{}>'.format(self.name)
+
+
+class JobResult(object):
+    """Outcome of a job executed by the scheduler"""
+    def __init__(self, job, value=None, error=None, duration=0.0):
+        self.job = job
+        self.value = value
+        self.error = error
+        self.duration = duration
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<JobResult:{}:{}>'.format(
+            self.job.name, 'ok' if self.succeeded else 'failed'
+        )
+
+
+def _create_executor(max_workers):
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=get_context('forkserver'),
+        initializer=_init_worker,
+        initargs=_get_logging_config(),
+    )
+
+
+def _get_logging_config():
+    """Return the levels of the loggers and the handlers of the root logger
+
+    Only the handlers writing to the standard error are returned, because
+    they can be created again in the worker without arguments.
+    """
+    root = getLogger()
+    levels = {
+        n: l.level
+        for n, l in root.manager.loggerDict.items()
+        if isinstance(l, Logger) and l.level
+    }
+    handlers = [
+        type(h) for h in root.handlers
+        if isinstance(h, StreamHandler) and h.stream is stderr
+    ]
+    return root.level, levels, handlers
+
+
+def _init_worker(root_level, levels, handlers):
+    """Configure the logging of the worker process like ours"""
+    root = getLogger()
+    root.setLevel(root_level)
+    for name, level in levels.items():
+        getLogger(name).setLevel(level)
+    for handler in handlers:
+        root.addHandler(handler())
+
+
+def _run_job(name, fn, args, kwargs):
+    """Run the job inside the worker process
+
+    Exceptions are converted to strings, because not all of them can be
+    pickled to be sent back to the parent process.  For the same reason,
+    the function must be defined on the module level and not be wrapped
+    by a decorator like with_fabric_settings.  The job is run with
+    COMMON_FABRIC_SETTINGS instead.  The spans recorded by the job are sent
+    back with the result.
+    """
+    # The worker might be reused from the previous job.
+    reset_trace()
+    start = time()
+    try:
+        with fabric.api.settings(**COMMON_FABRIC_SETTINGS), span('job', name):
+            value = fn(*args, **kwargs)
+    except (Exception, KeyboardInterrupt) as error:
+        log.error('Job failed: {}'.format(error))
+        return None, '{}: {}'.format(type(error).__name__, error), \
+            time() - start, collect_trace()
+    finally:
+        # The worker is reused for other jobs, we must not leave
+        # connections of this one behind.
+        disconnect_all()
+        close_virtconns()
+
+    return value, None, time() - start, collect_trace()
+
+
+class Scheduler(object):
+    """Run jobs concurrently with limits on the total and per slot kind
+
+    :param max_jobs: Maximum number of jobs running at the same time
+    :param slot_limits: Dict of slot kind to the maximum number of jobs
+                        running at the same time using the same slot
+    """
+    def __init__(self, max_jobs=1, slot_limits=None):
+        if max_jobs < 1:
+            raise ValueError('max_jobs must be at least 1')
+        self.max_jobs = max_jobs
+        self.slot_limits = slot_limits or {}
+        self._used = {}
+
+    def _available(self, job):
+        for slot in job.slots:
+            limit = self.slot_limits.get(slot[0])
+            if limit is not None and self._used.get(slot, 0) >= limit:
+                return False
+        return True
+
+    def _acquire(self, job):
+        for slot in job.slots:
+            self._used[slot] = self._used.get(slot, 0) + 1
+
+    def _release(self, job):
+        for slot in job.slots:
+            self._used[slot] -= 1
+
+    def run(self, jobs):
+        """Run all the jobs and return their results in the given order"""
+        jobs = list(jobs)
+        pending = list(jobs)
+        results = {}
+        running = {}
+
+        with _create_executor(self.max_jobs) as executor:
+            while pending or running:
+                for job in list(pending):
+                    if len(running) >= self.max_jobs:
+                        break
+                    if not self._available(job):
+                        continue
+                    pending.remove(job)
+                    self._acquire(job)
+                    log.info('Starting job "{}"'.format(job.name))
+                    future = executor.submit(
+                        _run_job, job.name, job.fn, job.args, job.kwargs
+                    )
+                    running[future] = job
+
+                if not running:
+                    # Can only happen with a slot limit lower than 1
+                    raise ValueError(
+                        'Jobs {} can never be scheduled'.format(pending)
+                    )
+
+                done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    self._release(job)
+                    results[job] = _get_result(job, future)
+                    log.info(
+                        'Job "{}" {} after {:.0f}s, {} left'.format(
+                            job.name,
+                            'failed' if results[job].error else 'finished',
+                            results[job].duration,
+                            len(pending) + len(running),
+                        )
+                    )
+
+        return [results[j] for j in jobs]
+
+
+def _get_result(job, future):
+    try:
+        value, error, duration, trace = future.result()
+        merge_trace(trace)
+    except Exception as exception:
+        # The worker process itself died
+        value, error, duration = None, str(exception), 0.0
+    return JobResult(job, value, error, duration)
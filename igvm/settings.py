@@ -36,6 +36,35 @@ COMMON_FABRIC_SETTINGS = dict(
 if  'IGVM_SSH_USER' in environ:
     COMMON_FABRIC_SETTINGS['user'] = environ.get('IGVM_SSH_USER')
 
+# The OpenSSH masters used by libvirt stay open for this many seconds after
+# their last connection is closed.  The SSH connections of Fabric are closed
+# when they were not used for this many seconds.
+SSH_CONTROL_PERSIST = 600
+SSH_POOL_IDLE_TIMEOUT = 300
+
+# libvirt connections are considered dead, when this many keepalive messages
+# sent every this many seconds are left unanswered.
+LIBVIRT_KEEPALIVE_INTERVAL = 5
+LIBVIRT_KEEPALIVE_COUNT = 3
+
+# Facts of the hypervisors like qemu version, NUMA topology and storage type
+# are cached for this many seconds.  They are also stored in the directory,
+# if one is given, to be shared by the igvm invocations.
+HYPERVISOR_FACTS_TTL = 3600
+HYPERVISOR_FACTS_CACHE_DIR = environ.get('IGVM_FACTS_CACHE_DIR')
+
+# Read-only commands serve the repeated Serveradmin queries from a cache for
+# this many seconds.  The cache is also stored in the directory, if one is
+# given, to be shared by the igvm invocations, like the ones of a script
+# looping through the VMs.  Any commit invalidates it.
+QUERY_CACHE_TTL = int(environ.get('IGVM_QUERY_CACHE_TTL', 10))
+QUERY_CACHE_DIR = environ.get('IGVM_QUERY_CACHE_DIR')
+
+# The trace of every command is written as a file into the directory, if
+# one is given, in "chrome" or "otlp" format to analyze many runs together.
+TRACE_DIR = environ.get('IGVM_TRACE_DIR')
+TRACE_FORMAT = environ.get('IGVM_TRACE_FORMAT', 'chrome')
+
 VG_NAME = 'xen-data'
 # Reserved pool space on Hypervisor
 # TODO: this could be a percent value, at least for ZFS.
@@ -96,6 +125,51 @@ MIGRATE_CONFIG = {
     ('buster', 'buster'): P2P_MIGRATION,
 }
 
+OFFLINE_TRANSPORTS = [
+    'drbd', 'netcat', 'netcat_zstd', 'netcat_parallel', 'netcat_diff',
+]
+
+# The netcat_diff offline transport compares the checksums of the blocks of
+# this size and only sends the differing ones.
+NETCAT_DIFF_BLOCK_SIZE = 4 * 1024 ** 2
+
+# The netcat_parallel offline transport splits the disk into this many
+# ranges and copies them over separate streams.  The ports are the free ones
+# in a separate range to not to collide with the single netcat stream.  The
+# search starts at a port derived from the device minor, so the concurrent
+# copies to different devices are unlikely to pick the same ones.
+NETCAT_PARALLEL_STREAMS = 4
+NETCAT_PARALLEL_MAX_STREAMS = 16
+NETCAT_PARALLEL_PORT_BASE = 30000
+NETCAT_PARALLEL_PORT_MAX = 39999
+
+# Stream codec used by the netcat_zstd offline transport.  Fast level with
+# all cores, long runs of zeroes cost almost nothing on the wire.
+NETCAT_COMPRESS = 'zstd -1 -T0 -q -c'
+NETCAT_DECOMPRESS = 'zstd -d -q -c'
+
+# DRBD migrations measure the throughput of the link between the hypervisors
+# and of the disks on both ends with this amount of data before configuring
+# the resync rate.  Only this share of the slowest of them is used, to leave
+# room for the I/O of the running VM.
+DRBD_PROBE_SIZE_MIB = 256
+DRBD_RESYNC_SHARE = 0.8
+
+# max-buffers setting of DRBD needed to reach the resync rate in MiB/s.
+# 32k seems jumpy and might end up at as low as 250MB/s, so we never go
+# above 24k.
+DRBD_MAX_BUFFERS = [
+    (150, '4k'),
+    (233, '8k'),
+    (330, '12k'),
+    (397, '16k'),
+    (561, '24k'),
+]
+
+# The events of DRBD only report the progress of the sync when its state
+# changes, so the statistics are also polled every this many seconds.
+DRBD_PROGRESS_INTERVAL = 10
+
 # Arbitrarily chosen MAC address prefix with U/L bit set
 # It will be padded with the last three octets of the internal IP address.
 MAC_ADDRESS_PREFIX = (0xCA, 0xFE, 0x01)
@@ -107,7 +181,20 @@ except KeyError:
     print('Please set the IGVM_IMAGE_URL environment variable')
     raise
 
-IMAGE_PATH = '/tmp'
+# The images are cached on the hypervisors in this directory.  The least
+# recently used ones are evicted when the cache grows above the budget.
+# Zero disables keeping them, they are streamed into the builds every time.
+# The builds waiting for an image being downloaded by another igvm for
+# longer than the extract timeout stream it without the cache.
+IMAGE_CACHE_PATH = '/var/cache/igvm/images'
+IMAGE_CACHE_SIZE_GIB = 20
+IMAGE_CACHE_LOCK_TIMEOUT = 600
+IMAGE_CACHE_EXTRACT_LOCK_TIMEOUT = 30
+
+# The new VMs are cloned from a formatted volume with the extracted image of
+# this size kept on every hypervisor.  The VMs with smaller disks are built
+# by extracting the image into their own volume.
+BASE_VOLUME_SIZE_GIB = 6
 
 HYPERVISOR_ATTRIBUTES = [
 #    'cpu_util_pct',
@@ -162,6 +249,24 @@ VM_ATTRIBUTES = [
     {'hypervisor': HYPERVISOR_ATTRIBUTES},
 ]
 
+# Columns of the output of the fleet-info command
+FLEET_INFO_COLUMNS = [
+    'hostname',
+    'hypervisor',
+    'state',
+    'status',
+    'num_cpu',
+    'vcpus',
+    'memory',
+    'memory_actual',
+    'memory_free',
+    'disk_size_gib',
+    'disk_capacity_gib',
+    'disk_free_gib',
+    'load',
+    'error',
+]
+
 AWS_RETURN_CODES = {
     'pending': 0,
     'running': 16,
@@ -267,6 +372,11 @@ AWS_CONFIG = [
     }
 ]
 
+# Number of the most preferred hypervisors to validate concurrently before
+# locking any of them.  The hypervisor is validated again after it is locked.
+# Zero validates the candidates one by one while holding their locks.
+HYPERVISOR_PREFETCH = int(environ.get('IGVM_HYPERVISOR_PREFETCH', 0))
+
 # The list is ordered from more important to less important.  The next
 # preference is only going to be checked when the previous ones return all
 # the same values.
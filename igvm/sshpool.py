@@ -0,0 +1,178 @@
+"""igvm - SSH Connection Pool
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+# We are talking to the hypervisors over two kinds of SSH connections: the
+# remote commands go through the Paramiko connections of Fabric, and libvirt
+# spawns the OpenSSH client for its qemu+ssh:// connections.  The libvirt
+# connections are pointed at our wrapper script, so they are multiplexed
+# over the OpenSSH master of the host listening on the control socket in
+# get_control_dir().  The master outlives igvm for a while, so that the
+# later libvirt connections, including the ones of the other igvm processes,
+# skip the handshake.
+#
+# Paramiko can't use these masters, so every igvm process still has two SSH
+# connections to a hypervisor it is using: the shared master of libvirt and
+# its own Fabric connection.  Fabric already keeps a single connection per
+# host.  We are checking their health before use and evicting the idle ones.
+
+from contextlib import contextmanager
+from logging import getLogger
+from os import (
+    chmod,
+    environ,
+    fdopen,
+    getpid,
+    getuid,
+    lstat,
+    mkdir,
+    path,
+    rename,
+)
+from stat import S_IMODE, S_ISDIR
+from tempfile import gettempdir, mkstemp
+from threading import Lock
+from time import time
+
+import fabric.state
+
+from igvm.exceptions import IGVMError
+from igvm.settings import SSH_CONTROL_PERSIST, SSH_POOL_IDLE_TIMEOUT
+
+log = getLogger(__name__)
+
+_last_used = {}
+# Number of the users of the connections by host string, like the threads
+_in_use = {}
+_inherited_connections = []
+_pid = getpid()
+_lock = Lock()
+_ssh_command = None
+
+
+def get_control_dir():
+    """Return the directory of the control sockets and the wrapper script
+
+    It is shared by all igvm processes of the same user.  The runtime
+    directory of the user is preferred over the shared temporary directory,
+    where somebody else could have created it.  We refuse to use it, if it
+    is not a directory only accessible by us.
+    """
+    runtime_dir = environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and path.isdir(runtime_dir):
+        control_dir = path.join(runtime_dir, 'igvm-ssh')
+    else:
+        control_dir = path.join(gettempdir(), 'igvm-ssh-{}'.format(getuid()))
+    try:
+        mkdir(control_dir, 0o700)
+    except FileExistsError:
+        pass
+
+    stat = lstat(control_dir)
+    if (
+        not S_ISDIR(stat.st_mode) or
+        stat.st_uid != getuid() or
+        S_IMODE(stat.st_mode) != 0o700
+    ):
+        raise IGVMError(
+            'Refusing to use "{}" for the SSH control sockets, it must be '
+            'a directory owned by us with mode 0700'.format(control_dir)
+        )
+    return control_dir
+
+
+def get_ssh_command():
+    """Return the path of the SSH command for libvirt using the masters
+
+    libvirt doesn't let us pass options to SSH, so we are writing them into
+    a wrapper script.  It is written once by every igvm process to pick up
+    the changed settings.  It is replaced atomically, because the other
+    igvm processes might be running it.
+    """
+    global _ssh_command
+
+    with _lock:
+        if _ssh_command is None:
+            control_dir = get_control_dir()
+            fd, tmp_file = mkstemp(prefix='.ssh-', dir=control_dir)
+            with fdopen(fd, 'w') as fp:
+                fp.write(
+                    '#!/bin/sh\n'
+                    'exec setsid ssh '
+                    '-o ControlMaster=auto '
+                    '-o ControlPath={}/%C '
+                    '-o ControlPersist={} '
+                    '"$@"\n'
+                    .format(control_dir, SSH_CONTROL_PERSIST)
+                )
+            chmod(tmp_file, 0o700)
+            _ssh_command = path.join(control_dir, 'ssh')
+            rename(tmp_file, _ssh_command)
+        return _ssh_command
+
+
+@contextmanager
+def use_connection(host_string):
+    """Prepare the Fabric connection to the host for the commands
+
+    The connection is dropped, if it died since the last use, for Fabric to
+    reconnect.  The connections idle for too long are closed.  The ones
+    used by the other threads, like the stages of a pipeline, are never
+    idle, however long ago they started to be used.
+    """
+    with _lock:
+        _forget_inherited_connections()
+        now = time()
+        for other, last_used in list(_last_used.items()):
+            if (
+                other != host_string and
+                not _in_use.get(other) and
+                now - last_used > SSH_POOL_IDLE_TIMEOUT
+            ):
+                log.debug('Closing idle SSH connection to {}'.format(other))
+                close_connection(other)
+
+        if (
+            not _in_use.get(host_string) and
+            host_string in fabric.state.connections
+        ):
+            transport = fabric.state.connections[host_string].get_transport()
+            if transport is None or not transport.is_active():
+                log.debug(
+                    'Dropping dead SSH connection to {}'.format(host_string)
+                )
+                close_connection(host_string)
+
+        _in_use[host_string] = _in_use.get(host_string, 0) + 1
+        _last_used[host_string] = now
+    try:
+        yield
+    finally:
+        with _lock:
+            _in_use[host_string] -= 1
+            _last_used[host_string] = time()
+
+
+def close_connection(host_string):
+    _last_used.pop(host_string, None)
+    if host_string in fabric.state.connections:
+        fabric.state.connections[host_string].close()
+        del fabric.state.connections[host_string]
+
+
+def _forget_inherited_connections():
+    """Forget the connections of the parent, if we are a forked process
+
+    They share the sockets with the parent process, so we must neither use
+    nor close them.  We are keeping the references to them, so that they
+    are not closed on garbage collection.
+    """
+    global _pid
+
+    if _pid == getpid():
+        return
+    _inherited_connections.extend(fabric.state.connections.values())
+    fabric.state.connections.clear()
+    _last_used.clear()
+    _in_use.clear()
+    _pid = getpid()
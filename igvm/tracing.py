@@ -0,0 +1,233 @@
+"""igvm - Tracing
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+# Spans are recorded around the remote commands, libvirt calls, Serveradmin
+# requests and the other things we are waiting for.  The ones taking the most
+# time are summarised at the end of every command.  The whole trace can be
+# exported as Chrome trace JSON, to be loaded into chrome://tracing or
+# Perfetto, or as OpenTelemetry (OTLP/JSON) file.
+#
+# The scheduler workers collect their spans and send them back to the parent
+# process with the result of the job.
+
+from contextlib import contextmanager
+from functools import wraps
+import json
+from logging import getLogger
+from os import getpid, urandom
+from threading import Lock, get_ident, local
+from time import time
+
+log = getLogger(__name__)
+
+# Only this many spans are kept for the export, the summary includes all.
+# These are not in the settings, because the settings import the utils,
+# which are traced themselves.
+MAX_SPANS = 100000
+SUMMARY_ROWS = 15
+
+_lock = Lock()
+_local = local()
+_spans = []
+# (category, name) to [count, total duration, max duration]
+_totals = {}
+_trace_id = urandom(16).hex()
+
+
+@contextmanager
+def span(category, name, **attributes):
+    """Record the time spent inside the context
+
+    The attributes can be extended inside the context through the yielded
+    dict.
+    """
+    stack = _get_stack()
+    span_id = urandom(8).hex()
+    parent_id = stack[-1] if stack else None
+    stack.append(span_id)
+    start = time()
+    try:
+        yield attributes
+    except BaseException as error:
+        attributes['error'] = type(error).__name__
+        raise
+    finally:
+        stack.pop()
+        record(
+            category, name, start, time() - start, attributes,
+            span_id, parent_id,
+        )
+
+
+def traced(category, name=None):
+    """Decorator to record a span around every call of the function"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(category, name or fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(category, name, start, duration, attributes=None, span_id=None,
+           parent_id=None):
+    """Record a span which was measured by other means"""
+    with _lock:
+        total = _totals.setdefault((category, name), [0, 0.0, 0.0])
+        total[0] += 1
+        total[1] += duration
+        total[2] = max(total[2], duration)
+
+        if len(_spans) >= MAX_SPANS:
+            return
+        _spans.append({
+            'category': category,
+            'name': name,
+            'start': start,
+            'duration': duration,
+            'pid': getpid(),
+            'tid': get_ident(),
+            'span_id': span_id or urandom(8).hex(),
+            'parent_id': parent_id,
+            'attributes': {
+                k: v if isinstance(v, (bool, int, float, str)) else str(v)
+                for k, v in (attributes or {}).items()
+                if v is not None
+            },
+        })
+
+
+def collect_trace():
+    """Return the recorded spans to be sent to another process"""
+    with _lock:
+        return {'spans': list(_spans), 'totals': dict(_totals)}
+
+
+def merge_trace(trace):
+    """Add the spans collected by another process"""
+    with _lock:
+        for key, (count, total, maximum) in trace['totals'].items():
+            current = _totals.setdefault(key, [0, 0.0, 0.0])
+            current[0] += count
+            current[1] += total
+            current[2] = max(current[2], maximum)
+        room = max(MAX_SPANS - len(_spans), 0)
+        _spans.extend(trace['spans'][:room])
+
+
+def reset_trace():
+    """Forget the spans, like the ones inherited by a forked worker"""
+    with _lock:
+        del _spans[:]
+        _totals.clear()
+
+
+def log_summary(wall_time):
+    """Log the spans taking the most time in total
+
+    The times are inclusive, the time of a DRBD phase for example includes
+    the time of the remote commands run by it.
+    """
+    with _lock:
+        rows = sorted(_totals.items(), key=lambda i: i[1][1], reverse=True)
+    rows = rows[:SUMMARY_ROWS]
+    if not rows:
+        return
+
+    names = ['{}:{}'.format(c, n)[:50] for (c, n), _ in rows]
+    width = max(len(n) for n in names)
+    log.info('Where the {:.1f}s went:'.format(wall_time))
+    log.info('    {} {:>6} {:>9} {:>8}'.format(
+        'span'.ljust(width), 'count', 'total', 'max'
+    ))
+    for name, (key, (count, total, maximum)) in zip(names, rows):
+        log.info('    {} {:>6} {:>8.1f}s {:>7.1f}s'.format(
+            name.ljust(width), count, total, maximum
+        ))
+
+
+def export_trace(file_name, trace_format='chrome'):
+    """Write the trace into the file in the given format"""
+    with _lock:
+        spans = list(_spans)
+
+    if trace_format == 'chrome':
+        data = {
+            'displayTimeUnit': 'ms',
+            'traceEvents': [
+                {
+                    'name': s['name'],
+                    'cat': s['category'],
+                    'ph': 'X',
+                    'ts': int(s['start'] * 1e6),
+                    'dur': int(s['duration'] * 1e6),
+                    'pid': s['pid'],
+                    'tid': s['tid'],
+                    'args': s['attributes'],
+                }
+                for s in spans
+            ],
+        }
+    elif trace_format == 'otlp':
+        data = {'resourceSpans': [{
+            'resource': {'attributes': [
+                _otlp_attribute('service.name', 'igvm'),
+            ]},
+            'scopeSpans': [{
+                'scope': {'name': 'igvm'},
+                'spans': [_otlp_span(s) for s in spans],
+            }],
+        }]}
+    else:
+        raise ValueError('Unknown trace format "{}"'.format(trace_format))
+
+    with open(file_name, 'w') as fd:
+        json.dump(data, fd)
+    log.debug('Trace with {} spans is written to {}'.format(
+        len(spans), file_name
+    ))
+
+
+def _get_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _otlp_span(s):
+    result = {
+        'traceId': _trace_id,
+        'spanId': s['span_id'],
+        'name': s['name'],
+        # SPAN_KIND_INTERNAL
+        'kind': 1,
+        'startTimeUnixNano': str(int(s['start'] * 1e9)),
+        'endTimeUnixNano': str(int((s['start'] + s['duration']) * 1e9)),
+        'attributes': [
+            _otlp_attribute('igvm.category', s['category']),
+            _otlp_attribute('process.pid', s['pid']),
+            _otlp_attribute('thread.id', s['tid']),
+        ] + [
+            _otlp_attribute(k, v) for k, v in sorted(s['attributes'].items())
+        ],
+    }
+    if s['parent_id']:
+        result['parentSpanId'] = s['parent_id']
+    if 'error' in s['attributes']:
+        # STATUS_CODE_ERROR
+        result['status'] = {'code': 2, 'message': s['attributes']['error']}
+    return result
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        value = {'boolValue': value}
+    elif isinstance(value, int):
+        value = {'intValue': str(value)}
+    elif isinstance(value, float):
+        value = {'doubleValue': value}
+    else:
+        value = {'stringValue': str(value)}
+    return {'key': key, 'value': value}
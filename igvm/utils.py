@@ -13,6 +13,7 @@ from os import path
 from paramiko import SSHConfig
 
 from igvm.exceptions import TimeoutError
+from igvm.tracing import traced
 
 
 _SIZE_FACTORS = {
@@ -56,6 +57,7 @@ class LazyCompare(object):
         return self.result
 
 
+@traced('wait')
 def retry_wait_backoff(fn_check, fail_msg, max_wait=20):
     """Continuously checks a conditional callback and retries with
     exponential backoff intervals until the condition is true.
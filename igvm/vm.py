@@ -22,7 +22,9 @@ from uuid import uuid4
 
 from igvm.exceptions import ConfigError, RemoteCommandError, VMError
 from igvm.host import Host
-from igvm.settings import AWS_RETURN_CODES
+from igvm.kvm import generate_domain_xml
+from igvm.pipeline import Pipeline
+from igvm.settings import AWS_RETURN_CODES, BASE_VOLUME_SIZE_GIB
 from igvm.transaction import Transaction
 from igvm.utils import parse_size, wait_until
 
@@ -371,20 +373,27 @@ class VM(Host):
 
     def meminfo(self):
         """Returns a dictionary of /proc/meminfo entries."""
-        contents = self.read_file('/proc/meminfo')
+        return self._parse_meminfo(
+            self.read_file('/proc/meminfo').decode()
+        )
+
+    @staticmethod
+    def _parse_meminfo(contents):
         result = {}
         for line in contents.splitlines():
             # XXX: What are we really expecting in here?
             try:
-                key, value = map(str.strip, line.decode().split(':'))
-            except IndexError:
+                key, value = map(str.strip, line.split(':'))
+            except (IndexError, ValueError):
                 continue
             result[key] = value
         return result
 
     def memory_free(self):
-        meminfo = self.meminfo()
+        return self._memory_free(self.meminfo())
 
+    @staticmethod
+    def _memory_free(meminfo):
         if 'MemAvailable' in meminfo:
             kib_free = parse_size(meminfo['MemAvailable'], 'K')
         # MemAvailable might not be present on old systems
@@ -405,6 +414,25 @@ class VM(Host):
             raise RemoteCommandError('Non-numeric output in disk_free')
         return round(float(output) / 1024 ** 2, 2)
 
+    def guest_stats(self):
+        """Returns free memory, free disk space and load of a running VM
+
+        Unlike calling memory_free(), disk_free() and reading loadavg one
+        by one, this needs only a single command on the VM.
+        """
+        meminfo, disk_free, load = self.run_batch([
+            'cat /proc/meminfo',
+            "df -k / | tail -n+2 | awk '{ print $4 }'",
+            'cat /proc/loadavg',
+        ], silent=True)
+        if not disk_free.isdigit():
+            raise RemoteCommandError('Non-numeric output in disk_free')
+        return {
+            'memory_free': self._memory_free(self._parse_meminfo(meminfo)),
+            'disk_free_gib': round(float(disk_free) / 1024 ** 2, 2),
+            'load': load.split()[:3],
+        }
+
     def info(self):
         result = {
             'hypervisor': self.hypervisor.fqdn,
@@ -416,12 +444,8 @@ class VM(Host):
 
         if self.hypervisor.vm_defined(self) and self.is_running():
             result.update(self.hypervisor.vm_sync_from_hypervisor(self))
-            result.update({
-                'status': 'running',
-                'memory_free': self.memory_free(),
-                'disk_free_gib': self.disk_free(),
-                'load': self.read_file('/proc/loadavg').split()[:3],
-            })
+            result['status'] = 'running'
+            result.update(self.guest_stats())
             result.update(self.hypervisor.vm_info(self))
         elif self.hypervisor.vm_defined(self):
             result['status'] = 'stopped'
@@ -446,22 +470,55 @@ class VM(Host):
             )
 
         with Transaction() as transaction:
-            # Perform operations on the hypervisor
-            self.hypervisor.create_vm_storage(self, transaction)
-            mount_path = self.hypervisor.format_vm_storage(self, transaction)
-
-            self.hypervisor.download_and_extract_image(image, mount_path)
-
-            self.prepare_vm()
+            pipeline = Pipeline('build of "{}"'.format(self.fqdn))
 
+            # Perform operations on the hypervisor
+            if self.dataset_obj['disk_size_gib'] >= BASE_VOLUME_SIZE_GIB:
+                def storage():
+                    return hypervisor.clone_vm_storage(
+                        self, image, transaction
+                    )
+                pipeline.add('storage', storage)
+                filled = 'storage'
+            else:
+                # The image is streamed straight into the new storage.  It
+                # is only read from the image cache of the hypervisor, if it
+                # is already there, so it is never downloaded twice.
+                def storage():
+                    hypervisor.create_vm_storage(self, transaction)
+                    return hypervisor.format_vm_storage(self, transaction)
+
+                def extract(mount_path):
+                    hypervisor.download_and_extract_image(image, mount_path)
+                pipeline.add('storage', storage)
+                pipeline.add('extract', extract, ['storage'])
+                filled = 'extract'
+
+            pipeline.add('prepare', lambda *a: self.prepare_vm(), [filled])
+            finished = ['prepare']
             if run_puppet:
-                self.run_puppet(clear_cert=True, debug=debug_puppet)
-
+                pipeline.add('puppet', lambda *a: self.run_puppet(
+                    clear_cert=True, debug=debug_puppet
+                ), ['prepare'])
+                finished.append('puppet')
             if postboot is not None:
-                self.copy_postboot_script(postboot)
+                pipeline.add('postboot', lambda *a: self.copy_postboot_script(
+                    postboot
+                ), ['prepare'])
+                finished.append('postboot')
 
-            self.hypervisor.umount_vm_storage(self)
-            hypervisor.define_vm(self, transaction)
+            # The domain XML only needs libvirt, it is generated while the
+            # commands are running on the hypervisor.
+            pipeline.add('domain_xml', lambda *a: generate_domain_xml(
+                hypervisor, self
+            ), ['storage'], remote=False)
+
+            def define(domain_xml, *args):
+                hypervisor.umount_vm_storage(self)
+                hypervisor.define_vm(self, transaction, domain_xml)
+            pipeline.add('define', define, ['domain_xml'] + finished)
+
+            pipeline.run()
 
             # We are updating the information on the Serveradmin, before
             # starting the VM, because the VM would still be on the hypervisor
@@ -643,25 +700,28 @@ class VM(Host):
         self.create_ssh_keys()
 
     def create_ssh_keys(self):
-        # If we wouldn't do remove those, ssh-keygen would ask us confirm
-        # overwrite.
-        self.run('rm -f /etc/ssh/ssh_host_*_key*')
-
         self.dataset_obj['sshfp'] = set()
         key_types = [(1, 'rsa'), (3, 'ecdsa')]
         if self.dataset_obj['os'] != 'wheezy':
             key_types.append((4, 'ed25519'))
         fp_types = [(1, sha1), (2, sha256)]
 
+        # If we wouldn't do remove those, ssh-keygen would ask us confirm
+        # overwrite.
+        commands = ['rm -f /etc/ssh/ssh_host_*_key*']
         # This will also create the public key files.
         for key_id, key_type in key_types:
-            self.run(
+            commands.append(
                 'ssh-keygen -q -t {0} -N "" '
-                '-f /etc/ssh/ssh_host_{0}_key'.format(key_type))
+                '-f /etc/ssh/ssh_host_{0}_key'.format(key_type)
+            )
+            commands.append(
+                'cat /etc/ssh/ssh_host_{0}_key.pub'.format(key_type)
+            )
+        results = self.run_batch(commands)
 
-            fd = BytesIO()
-            self.get('/etc/ssh/ssh_host_{0}_key.pub'.format(key_type), fd)
-            pub_key = b64decode(fd.getvalue().split(None, 2)[1])
+        for (key_id, key_type), result in zip(key_types, results[2::2]):
+            pub_key = b64decode(result.split(None, 2)[1])
             for fp_id, fp_type in fp_types:
                 self.dataset_obj['sshfp'].add('{} {} {}'.format(
                     key_id, fp_id, fp_type(pub_key).hexdigest()
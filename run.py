@@ -9,4 +9,6 @@ Copyright (c) 2017 InnoGames GmbH
 
 from igvm.cli import main
 
-main()
+# The fork server of the scheduler imports this module as well.
+if __name__ == '__main__':
+    main()
@@ -27,7 +27,7 @@ setup(
             'templates/etc/hosts',
             'templates/etc/inittab',
             'templates/etc/resolv.conf',
-            'scripts/ssh_wrapper',
+            'scripts/blockdiff',
         ]
     },
     author='InnoGames System Administration',
@@ -40,6 +40,7 @@ from igvm.exceptions import (
     VMError,
 )
 from igvm.hypervisor import Hypervisor
+from igvm.imagecache import ImageCache
 from igvm.settings import (
     COMMON_FABRIC_SETTINGS,
     HYPERVISOR_ATTRIBUTES,
@@ -329,6 +330,23 @@ class BuildTest(IGVMTest):
             vm.run('test ! -f /root/initial_canary')
 
 
+class ImageCacheTest(TestCase):
+    """Test the image cache on the hypervisors"""
+
+    def test_extract_cached_image(self):
+        hv = HYPERVISORS[0]
+        image = 'stretch-base.tar.gz'
+        digest = ImageCache(hv).prefetch(image)
+        self.assertIn(digest, ImageCache(hv).get_digests())
+
+        target_dir = hv.run('mktemp -d').strip()
+        try:
+            self.assertEqual(ImageCache(hv).extract(image, target_dir), digest)
+            hv.run(cmd('test -x {}/bin/sh', target_dir))
+        finally:
+            hv.run(cmd('rm -rf {}', target_dir))
+
+
 class CommandTest(IGVMTest):
     def setUp(self):
         super(CommandTest, self).setUp()
@@ -550,6 +568,40 @@ class MigrationTest(IGVMTest):
         )
         self.check_vm_present()
 
+    def test_offline_migration_netcat_zstd(self):
+        vm_migrate(
+            VM_HOSTNAME,
+            offline=True,
+            offline_transport='netcat_zstd',
+        )
+        self.check_vm_present()
+
+    def test_offline_migration_netcat_parallel(self):
+        vm_migrate(
+            VM_HOSTNAME,
+            offline=True,
+            offline_transport='netcat_parallel',
+        )
+        self.check_vm_present()
+
+    def test_offline_migration_netcat_diff(self):
+        hypervisor = self.vm.hypervisor.fqdn
+        vm_migrate(
+            VM_HOSTNAME,
+            offline=True,
+            offline_transport='netcat_diff',
+            keep_source_storage=True,
+        )
+
+        # Migrating back should reuse the kept volume
+        vm_migrate(
+            VM_HOSTNAME,
+            hypervisor_hostname=hypervisor,
+            offline=True,
+            offline_transport='netcat_diff',
+        )
+        self.check_vm_present()
+
     def test_offline_migration_drbd(self):
         vm_migrate(
             VM_HOSTNAME,
@@ -0,0 +1,343 @@
+"""igvm - Unit Tests
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from igvm.drbd import DRBDSyncProgress, parse_dd_rate
+from igvm.exceptions import RemoteCommandError
+from igvm.host import BATCH_MARKER, Host
+from igvm.hypervisor import Hypervisor
+from igvm.scheduler import Job, Scheduler
+from igvm.settings import (
+    HOST_RESERVED_MEMORY,
+    RESERVED_DISK,
+    VM_OVERHEAD_MEMORY,
+)
+
+
+class _Tracker(object):
+    """Record the maximum number of jobs running at the same time"""
+    def __init__(self):
+        self.lock = Lock()
+        self.running = {}
+        self.maximum = {}
+
+    def enter(self, key):
+        with self.lock:
+            self.running[key] = self.running.get(key, 0) + 1
+            self.maximum[key] = max(
+                self.maximum.get(key, 0), self.running[key]
+            )
+
+    def exit(self, key):
+        with self.lock:
+            self.running[key] -= 1
+
+
+def _tracked_job(tracker, slot, value):
+    tracker.enter('total')
+    if slot:
+        tracker.enter(slot)
+    try:
+        sleep(0.05)
+    finally:
+        if slot:
+            tracker.exit(slot)
+        tracker.exit('total')
+    return value
+
+
+def _failing_job():
+    raise ValueError('boom')
+
+
+class SchedulerTest(TestCase):
+    def setUp(self):
+        # The jobs run in threads of this process instead of workers, so
+        # they can share the tracker.
+        patchers = [
+            patch(
+                'igvm.scheduler._create_executor',
+                lambda max_workers: ThreadPoolExecutor(max_workers),
+            ),
+            patch('igvm.scheduler.disconnect_all'),
+            patch('igvm.scheduler.close_virtconns'),
+            patch('igvm.scheduler.fabric.api.settings'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.tracker = _Tracker()
+
+    def _job(self, name, slot=None):
+        return Job(
+            name,
+            _tracked_job,
+            (self.tracker, slot, name),
+            slots=[slot] if slot else [],
+        )
+
+    def test_results_in_order(self):
+        jobs = [self._job('job{}'.format(i)) for i in range(5)]
+        results = Scheduler(3).run(jobs)
+
+        self.assertEqual([r.job for r in results], jobs)
+        self.assertEqual([r.value for r in results], [j.name for j in jobs])
+        self.assertTrue(all(r.succeeded for r in results))
+
+    def test_max_jobs(self):
+        Scheduler(2).run(self._job('job{}'.format(i)) for i in range(5))
+
+        self.assertEqual(self.tracker.maximum['total'], 2)
+
+    def test_slot_limits(self):
+        jobs = [
+            self._job('job{}'.format(i), ('hypervisor', 'hv0{}'.format(i % 2)))
+            for i in range(6)
+        ]
+        Scheduler(4, {'hypervisor': 1}).run(jobs)
+
+        self.assertEqual(self.tracker.maximum[('hypervisor', 'hv00')], 1)
+        self.assertEqual(self.tracker.maximum[('hypervisor', 'hv01')], 1)
+        self.assertLessEqual(self.tracker.maximum['total'], 2)
+
+    def test_failed_job(self):
+        results = Scheduler(2).run([
+            Job('failing', _failing_job), self._job('working'),
+        ])
+
+        self.assertFalse(results[0].succeeded)
+        self.assertEqual(results[0].error, 'ValueError: boom')
+        self.assertTrue(results[1].succeeded)
+        self.assertEqual(results[1].value, 'working')
+
+    def test_unschedulable(self):
+        with self.assertRaises(ValueError):
+            Scheduler(1, {'hypervisor': 0}).run([
+                self._job('job', ('hypervisor', 'hv00')),
+            ])
+
+    def test_invalid_max_jobs(self):
+        with self.assertRaises(ValueError):
+            Scheduler(0)
+
+    def test_slots_without_name(self):
+        self.assertEqual(Job('job', _failing_job, slots=[
+            ('source', None), ('hypervisor', 'hv00'),
+        ]).slots, (('hypervisor', 'hv00'), ))
+
+
+def _batch_output(*steps):
+    """Build the output of run_batch() from (output, return code) tuples"""
+    return ''.join(
+        '{}\n\n{} {} {}\n'.format(output, BATCH_MARKER, index, return_code)
+        for index, (output, return_code) in enumerate(steps)
+    )
+
+
+class RunBatchTest(TestCase):
+    def setUp(self):
+        self.host = Host({
+            'hostname': 'hv01.example.com',
+            'intern_ip': '10.0.0.1',
+            'route_network': None,
+        })
+
+    def test_results(self):
+        with patch.object(Host, 'run', return_value=_batch_output(
+            ('foo', 0), ('bar\nbaz', 0),
+        )) as run:
+            results = self.host.run_batch(['echo foo', 'echo bar; echo baz'])
+
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(results, ['foo', 'bar\nbaz'])
+        self.assertEqual(results[1].command, 'echo bar; echo baz')
+        self.assertEqual(results[1].return_code, 0)
+        self.assertTrue(all(r.succeeded for r in results))
+
+    def test_stops_at_failure(self):
+        with patch.object(Host, 'run', return_value=_batch_output(
+            ('foo', 0), ('error', 2),
+        )) as run:
+            with self.assertRaises(RemoteCommandError) as context:
+                self.host.run_batch(['true', 'false', 'true'])
+
+        self.assertIn('[ $igvm_rc -eq 0 ] || exit 0', run.call_args[0][0])
+        self.assertIn('"false"', str(context.exception))
+        self.assertIn('exit code 2', str(context.exception))
+
+    def test_stopped_early(self):
+        with patch.object(Host, 'run', return_value=_batch_output(
+            ('foo', 0),
+        )):
+            with self.assertRaises(RemoteCommandError) as context:
+                self.host.run_batch(['true', 'true'])
+
+        self.assertIn('stopped before', str(context.exception))
+
+    def test_warn_only(self):
+        with patch.object(Host, 'run', return_value=_batch_output(
+            ('foo', 0), ('error', 1), ('bar', 0),
+        )) as run:
+            results = self.host.run_batch(
+                ['true', 'false', 'true'], warn_only=True
+            )
+
+        self.assertNotIn('exit 0', run.call_args[0][0])
+        self.assertEqual([r.return_code for r in results], [0, 1, 0])
+        self.assertTrue(results[1].failed)
+
+
+def _events2_line(resource, out_of_sync_kib):
+    return (
+        '[10.0.0.1] out: change peer-device name:{} peer-node-id:1 '
+        'conn-name:hv02 volume:0 replication:SyncSource '
+        'peer-disk:Inconsistent out-of-sync:{}\n'
+        .format(resource, out_of_sync_kib)
+    )
+
+
+class DRBDTest(TestCase):
+    def test_parse_dd_rate(self):
+        self.assertEqual(parse_dd_rate(
+            '1073741824 bytes (1.1 GB, 1.0 GiB) copied, 2 s, 537 MB/s'
+        ), 512.0)
+        self.assertEqual(parse_dd_rate(
+            '268435456 bytes (268 MB) copied, 0.5 s, 537 MB/s'
+        ), 512.0)
+
+    def test_parse_dd_rate_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_dd_rate('dd: failed to open')
+
+    def test_sync_progress(self):
+        size_kib = 1024 ** 2
+        with patch('igvm.drbd.time', side_effect=[0, 100, 110, 120]):
+            progress = DRBDSyncProgress('vm1', size_kib * 1024)
+            progress.write(_events2_line('vm1', size_kib))
+            self.assertEqual(progress.last, (100, 0))
+            self.assertIsNone(progress.rate)
+
+            # The lines can arrive in pieces, and as bytes
+            line = _events2_line('vm1', size_kib // 2).encode()
+            progress.write(line[:20])
+            progress.write(line[20:])
+            self.assertEqual(progress.last, (110, 512 * 1024 ** 2))
+            self.assertEqual(progress.rate, 512 * 1024 ** 2 / 10)
+
+            progress.write(_events2_line('vm1', size_kib // 4))
+            self.assertEqual(progress.last, (120, 768 * 1024 ** 2))
+            self.assertAlmostEqual(
+                progress.rate,
+                0.7 * 512 * 1024 ** 2 / 10 + 0.3 * 256 * 1024 ** 2 / 10,
+            )
+
+    def test_sync_progress_polled(self):
+        # The polled statistics come as the current state
+        with patch('igvm.drbd.time', return_value=0):
+            progress = DRBDSyncProgress('vm1', 1024 ** 3)
+            progress.write(_events2_line('vm1', 1024).replace(
+                'change', 'exists'
+            ))
+        self.assertEqual(progress.last, (0, 1023 * 1024 ** 2))
+
+    def test_sync_progress_other_lines(self):
+        with patch('igvm.drbd.time', return_value=0):
+            progress = DRBDSyncProgress('vm1', 1024 ** 3)
+            progress.write(_events2_line('vm2', 0))
+            progress.write('[10.0.0.1] out: exists resource name:vm1\n')
+            progress.write('change peer-device name:vm1 replication:Estab')
+        self.assertIsNone(progress.last)
+        self.assertEqual(progress.buffer, 'change peer-device name:vm1 '
+                         'replication:Estab')
+
+
+class PlacementAccountingTest(TestCase):
+    def setUp(self):
+        self.hypervisor = Hypervisor({
+            'hostname': 'hv01.example.com',
+            'intern_ip': '10.0.0.1',
+            'route_network': None,
+            'state': 'online',
+            'vms': [
+                {'hostname': 'vm1', 'function': 'web', 'memory': 1024},
+                {'hostname': 'vm2', 'function': 'web', 'memory': 2048},
+                {'hostname': 'vm3', 'function': 'db', 'memory': 4096},
+            ],
+        })
+
+    def _plan(self, hostname, function, memory, disk_size_gib=10):
+        vm = MagicMock()
+        vm.dataset_obj = {
+            'hostname': hostname,
+            'function': function,
+            'memory': memory,
+            'disk_size_gib': disk_size_gib,
+        }
+        self.hypervisor.plan_vm(vm)
+
+    def test_vms_counter(self):
+        counter = self.hypervisor.vms_counter(['function'])
+        self.assertEqual(counter[('web', )], 2)
+        self.assertIs(self.hypervisor.vms_counter(['function']), counter)
+
+        self._plan('vm4', 'db', 1024)
+        counter = self.hypervisor.vms_counter(['function'])
+        self.assertEqual(counter[('web', )], 2)
+        self.assertEqual(counter[('db', )], 2)
+
+    def test_vms_total(self):
+        self.assertEqual(self.hypervisor.vms_total('memory'), 7168)
+        self._plan('vm4', 'db', 1024)
+        self.assertEqual(self.hypervisor.vms_total('memory'), 8192)
+
+    def test_copy_shares_planned_vms(self):
+        copy = self.hypervisor.copy()
+        self._plan('vm4', 'db', 1024)
+        self.assertEqual(copy.vms_total('memory'), 8192)
+
+    def test_free_vm_memory(self):
+        hypervisor = self.hypervisor
+        with patch.object(hypervisor, 'get_facts', return_value={
+            'total_memory_kib': 64 * 1024 ** 2,
+        }), patch.object(
+            hypervisor, 'get_storage_type', return_value='logical',
+        ), patch.object(hypervisor, 'get_domain_stats', return_value={
+            'vm1': {'balloon.current': 1024 ** 2},
+            'vm2': {'balloon.current': 2 * 1024 ** 2},
+            'vm3': {},
+        }):
+            free_mib = (
+                64 * 1024 - HOST_RESERVED_MEMORY['logical'] -
+                (3 * 1024 - VM_OVERHEAD_MEMORY)
+            )
+            self.assertEqual(hypervisor.free_vm_memory(), free_mib)
+
+            self._plan('vm4', 'db', 1024)
+            self.assertEqual(hypervisor.free_vm_memory(), free_mib - 1024)
+
+    def test_free_disk_size(self):
+        hypervisor = self.hypervisor
+        storage_pool = MagicMock()
+        storage_pool.info.return_value = [0, 0, 0, 500 * 1024 ** 3]
+        with patch.object(
+            hypervisor, 'get_storage_pool', return_value=storage_pool,
+        ), patch.object(
+            hypervisor, 'get_storage_type', return_value='logical',
+        ):
+            free_gib = 500 - RESERVED_DISK['logical']
+            self.assertEqual(hypervisor.get_free_disk_size_gib(), free_gib)
+
+            self._plan('vm4', 'db', 1024, 30)
+            self.assertEqual(
+                hypervisor.get_free_disk_size_gib(), free_gib - 30
+            )
+            self.assertEqual(
+                hypervisor.get_free_disk_size_gib(safe=False), 470
+            )